@@ -0,0 +1,45 @@
+"""
+Benchmark of the region measurement backends of get_statck_properties
+
+    python benchmarks/label_statistics.py
+"""
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from skimage.draw import disk
+from napari_intensity_step_detection.utils.track_utils import get_statck_properties
+
+
+def synthetic_stack(frames=200, shape=(512, 512), spots=300, seed=0):
+    rng = np.random.default_rng(seed)
+    images = rng.normal(100, 10, size=(frames,) + shape).astype(np.float32)
+    masks = np.zeros((frames,) + shape, dtype=np.uint8)
+    for t in range(frames):
+        for y, x in rng.uniform(4, shape[0] - 4, size=(spots, 2)):
+            rr, cc = disk((y, x), rng.uniform(1.5, 3.5), shape=shape)
+            masks[t, rr, cc] = 1
+            images[t, rr, cc] += 200
+    return masks, images
+
+
+def benchmark_label_statistics(frames=200, shape=(512, 512), spots=300, repeat=3):
+    masks, images = synthetic_stack(frames=frames, shape=shape, spots=spots)
+    timings = {}
+    results = {}
+    for backend in ['skimage', 'ndimage']:
+        best = np.inf
+        for _ in range(repeat):
+            start = perf_counter()
+            results[backend] = get_statck_properties(masks, images, backend=backend)
+            best = min(best, perf_counter() - start)
+        timings[backend] = best
+    pd.testing.assert_frame_equal(results['skimage'], results['ndimage'])
+    return timings, len(results['skimage'])
+
+
+if __name__ == "__main__":
+    timings, detections = benchmark_label_statistics()
+    print(f"{detections} detections")
+    for backend, seconds in timings.items():
+        print(f"{backend:>8}: {seconds:.3f} s")
+    print(f" speedup: {timings['skimage'] / timings['ndimage']:.1f}x")
@@ -0,0 +1,51 @@
+"""
+Benchmark of the trackpy and kdtree linking backends of get_tracks on dense synthetic data
+
+    python benchmarks/linking.py
+"""
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import trackpy
+from napari_intensity_step_detection.utils.track_utils import get_tracks
+
+
+def synthetic_detections(particles=5000, frames=50, size=512, step=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(0, size, size=(particles, 2))
+    data = []
+    for t in range(frames):
+        positions = positions + rng.normal(0, step, size=positions.shape)
+        data.append(pd.DataFrame({'frame': t, 'y': positions[:, 0], 'x': positions[:, 1],
+                                  'truth': np.arange(particles)}))
+    return pd.concat(data, ignore_index=True)
+
+
+def correct_links(df):
+    # fraction of the true frame to frame links found by the linker
+    df = df.sort_values(['truth', 'frame'])
+    same_truth = df['truth'].to_numpy()[1:] == df['truth'].to_numpy()[:-1]
+    same_particle = df['particle'].to_numpy()[1:] == df['particle'].to_numpy()[:-1]
+    return np.count_nonzero(same_truth & same_particle) / np.count_nonzero(same_truth)
+
+
+def benchmark_linking(particles=5000, frames=50, size=512, search_range=5, memory=0):
+    df = synthetic_detections(particles=particles, frames=frames, size=size)
+    result = {}
+    for backend in ['trackpy', 'kdtree']:
+        start = perf_counter()
+        try:
+            linked = get_tracks(df, search_range=search_range, memory=memory, backend=backend)
+        except trackpy.linking.SubnetOversizeException as e:
+            result[backend] = (perf_counter() - start, f"failed: {e}")
+            continue
+        result[backend] = (perf_counter() - start, correct_links(linked))
+    return result
+
+
+if __name__ == "__main__":
+    for search_range in [3, 5, 8]:
+        print(f"search_range {search_range}")
+        for backend, (seconds, links) in benchmark_linking(search_range=search_range).items():
+            links = links if isinstance(links, str) else f"{links:.4f} correct links"
+            print(f"{backend:>8}: {seconds:.2f} s, {links}")
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from napari_intensity_step_detection.utils.track_utils import _ChannelStack
+
+
+def test_channel_stack_frames_are_time_y_x_channel():
+    rng = np.random.default_rng(0)
+    stack = rng.random((5, 3, 8, 6))
+    expected = np.moveaxis(stack, 1, -1)
+    for channel_axis, images in ((0, np.moveaxis(stack, 1, 0)), (1, stack), (3, expected), (-1, expected)):
+        channels = _ChannelStack(images, channel_axis=channel_axis)
+        assert channels.shape == (5, 8, 6)
+        np.testing.assert_array_equal(channels[2], expected[2])
+        np.testing.assert_array_equal(channels[np.int64(4)], expected[4])
+        np.testing.assert_array_equal(channels[1:3], expected[1:3])
+    channels = _ChannelStack([stack[:, 0], stack[:, 1]])
+    np.testing.assert_array_equal(channels[2], expected[2, ..., :2])
+    with pytest.raises(ValueError):
+        channels[2, 0]
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import trackpy
+
+from napari_intensity_step_detection.utils.linking import IncrementalLinker
+
+
+def _detections(n_particles=40, n_frames=30, seed=0):
+    rng = np.random.default_rng(seed)
+    start = rng.random((n_particles, 2)) * 200
+    rows = []
+    for frame in range(n_frames):
+        position = start + rng.normal(scale=0.5, size=(n_particles, 2)) * np.sqrt(frame + 1)
+        # some particles are missed in some frames and frame 12 has no detections at all
+        seen = rng.random(n_particles) > 0.1
+        if frame != 12:
+            rows.append(pd.DataFrame({'frame': frame, 'y': position[seen, 0], 'x': position[seen, 1]}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def test_incremental_linker_matches_trackpy_link():
+    trackpy.quiet()
+    df = _detections()
+    expected = trackpy.link(df, search_range=3, memory=2, pos_columns=['y', 'x'])
+
+    linker = IncrementalLinker(search_range=3, memory=2)
+    for first, last in ((0, 4), (5, 5), (6, 17), (18, 29)):
+        linker.append(df[(df['frame'] >= first) & (df['frame'] <= last)])
+    linked = linker.to_pd()
+
+    assert len(linked) == len(df)
+    np.testing.assert_array_equal(linked['particle'].to_numpy(),
+                                  expected.loc[linked.index, 'particle'].to_numpy())
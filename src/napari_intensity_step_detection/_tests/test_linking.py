@@ -0,0 +1,120 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import trackpy
+
+from napari_intensity_step_detection.utils.linking import (
+    close_gaps,
+    link_kdtree,
+    link_partitioned,
+    sparse_assignment,
+)
+
+
+def _grouping(particle):
+    # first row of the track of every row, the same for any numbering of the tracks
+    _, first, inverse = np.unique(particle, return_index=True, return_inverse=True)
+    return first[inverse]
+
+
+def _moving_particles(n_particles=60, n_frames=25, size=256, seed=0):
+    # particles on a grid drifting across the tile borders, well apart from each other
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(np.arange(10, size, 32), np.arange(10, size, 32)), axis=-1).reshape(-1, 2)
+    start = grid[rng.choice(len(grid), size=n_particles, replace=False)].astype(np.float64)
+    velocity = rng.uniform(-1.5, 1.5, size=(n_particles, 2))
+    rows = []
+    for frame in range(n_frames):
+        position = start + velocity * frame + rng.normal(scale=0.2, size=(n_particles, 2))
+        rows.append(pd.DataFrame({'frame': frame, 'y': position[:, 0], 'x': position[:, 1]}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def test_link_partitioned_groups_as_trackpy():
+    trackpy.quiet()
+    df = _moving_particles()
+    expected = trackpy.link(df, search_range=4, memory=0, pos_columns=['y', 'x'])
+    linked = link_partitioned(df, search_range=4, memory=0, tile_shape=(64, 64), n_workers=2)
+
+    # the tracks cross the tile borders
+    tile = np.floor(df[['y', 'x']].to_numpy() / 64).astype(int)
+    crossing = pd.DataFrame(tile).groupby(expected['particle'].to_numpy()).nunique().max(axis=1)
+    assert (crossing > 1).sum() > 10
+
+    assert len(linked) == len(df)
+    np.testing.assert_array_equal(_grouping(linked.loc[df.index, 'particle'].to_numpy()),
+                                  _grouping(expected.loc[df.index, 'particle'].to_numpy()))
+
+
+def _segment(particle, frames, y, x):
+    frames = np.asarray(frames)
+    return pd.DataFrame({'frame': frames, 'y': y + 0.1 * (frames % 2), 'x': x + 0.1 * frames,
+                         'particle': particle})
+
+
+def test_close_gaps_joins_short_gaps_only():
+    df = pd.concat([
+        # 2 missing frames (10, 11) and 0.5 px apart: joined
+        _segment(0, range(10), 50, 50), _segment(1, range(12, 20), 50.5, 51),
+        # 3 missing frames: not joined with max_gap=2
+        _segment(2, range(10), 150, 150), _segment(3, range(13, 20), 150, 151),
+        # 1 missing frame but 10 px apart: not joined with max_distance=4
+        _segment(4, range(10), 100, 20), _segment(5, range(11, 20), 100, 31),
+        # the same frame, overlapping tracks are never joined
+        _segment(6, range(10), 200, 80), _segment(7, range(9, 20), 200.5, 81),
+    ], ignore_index=True)
+
+    joined = close_gaps(df, max_gap=2, max_distance=4)
+    grouping = _grouping(joined['particle'].to_numpy())
+    segment = df['particle'].to_numpy()
+    assert len(np.unique(grouping[segment == 0])) == 1
+    assert np.all(grouping[segment == 0] == grouping[segment == 1][0])
+    for a, b in ((2, 3), (4, 5), (6, 7)):
+        assert grouping[segment == a][0] != grouping[segment == b][0]
+    assert len(np.unique(grouping)) == 7
+
+    # a larger max_gap joins the 3 frames gap as well
+    joined = close_gaps(df, max_gap=3, max_distance=4)
+    assert joined['particle'].nunique() == 6
+
+
+def _assignment_cost(pairs, cost, n_source, n_target, no_link_cost):
+    # every source and target left unassigned costs no_link_cost
+    return sum(cost[pairs]) + no_link_cost * (n_source + n_target - 2 * len(pairs))
+
+
+def test_sparse_assignment_is_minimal():
+    rng = np.random.default_rng(4)
+    for _ in range(20):
+        n_source, n_target = rng.integers(1, 5, size=2)
+        candidates = [(s, t) for s in range(n_source) for t in range(n_target) if rng.random() < 0.6]
+        source = np.array([s for s, _ in candidates], dtype=np.int64)
+        target = np.array([t for _, t in candidates], dtype=np.int64)
+        cost = rng.random(len(candidates)) * 2
+        no_link_cost = 0.6
+
+        matchings = [list(pairs) for k in range(len(candidates) + 1)
+                     for pairs in itertools.combinations(range(len(candidates)), k)
+                     if len({source[p] for p in pairs}) == k and len({target[p] for p in pairs}) == k]
+        best = min(_assignment_cost(pairs, cost, n_source, n_target, no_link_cost) for pairs in matchings)
+        assigned_source, assigned_target = sparse_assignment(source, target, cost, n_source, n_target,
+                                                             no_link_cost)
+        assert len(set(assigned_source)) == len(assigned_source)
+        assert len(set(assigned_target)) == len(assigned_target)
+        pairs = [candidates.index((s, t)) for s, t in zip(assigned_source, assigned_target)]
+        np.testing.assert_allclose(_assignment_cost(pairs, cost, n_source, n_target, no_link_cost), best,
+                                   atol=1e-6)
+
+
+def test_link_kdtree_groups_as_trackpy():
+    trackpy.quiet()
+    df = _moving_particles(n_particles=50, seed=5)
+    # some detections are missed, the memory links over them
+    df = df.drop(df.sample(frac=0.05, random_state=5).index)
+    for memory in (0, 1):
+        expected = trackpy.link(df, search_range=4, memory=memory, pos_columns=['y', 'x'])
+        linked = link_kdtree(df, search_range=4, memory=memory)
+        assert len(linked) == len(df)
+        np.testing.assert_array_equal(_grouping(linked.loc[df.index, 'particle'].to_numpy()),
+                                      _grouping(expected.loc[df.index, 'particle'].to_numpy()))
@@ -0,0 +1,74 @@
+import numpy as np
+
+from napari_intensity_step_detection.utils.track_utils import (
+    basic_msd_fit,
+    batch_msd,
+    batch_msd_fit,
+    msd,
+)
+
+
+def _random_walk(n_points, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(size=(n_points, 2)), axis=0) + 100
+
+
+def test_fft_msd_matches_direct():
+    pos = _random_walk(300)
+    direct = msd(pos, limit=50)
+    fft = msd(pos, limit=50, method='fft')
+    np.testing.assert_allclose(fft.to_numpy(), direct.to_numpy(), rtol=1e-8, atol=1e-8)
+    np.testing.assert_array_equal(fft.index, direct.index)
+
+
+def test_fft_msd_matches_direct_with_gaps():
+    # positions reindexed over the frames, the missing frames are nan
+    pos = _random_walk(300, seed=1)
+    pos[[5, 6, 40, 41, 42, 200]] = np.nan
+    direct = msd(pos, limit=50)
+    fft = msd(pos, limit=50, method='fft')
+    np.testing.assert_allclose(fft.to_numpy(), direct.to_numpy(), rtol=1e-8, atol=1e-8)
+
+
+def test_batch_fft_msd_matches_direct_with_frame_gaps():
+    rng = np.random.default_rng(2)
+    lengths = [3, 10, 64, 65, 200]
+    points, frames = [], []
+    for length in lengths:
+        # every track skips some frames, filled with nan by _fill_gaps
+        frame = np.sort(rng.choice(int(length * 1.3) + 1, size=length, replace=False)) + 7
+        frames.append(frame)
+        points.append(_random_walk(length, seed=length))
+    points, frames = np.concatenate(points), np.concatenate(frames)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    for limit in (5, 40, None):
+        direct, direct_counts = batch_msd(points, offsets, limit=limit, frames=frames)
+        fft, fft_counts = batch_msd(points, offsets, limit=limit, frames=frames, method='fft')
+        np.testing.assert_array_equal(fft_counts, direct_counts)
+        np.testing.assert_allclose(fft, direct, rtol=1e-8, atol=1e-8)
+
+    # without frames the lags are in rows
+    direct, _ = batch_msd(points, offsets, limit=30)
+    fft, _ = batch_msd(points, offsets, limit=30, method='fft')
+    np.testing.assert_allclose(fft, direct, rtol=1e-8, atol=1e-8)
+
+
+def test_batch_msd_fit_matches_basic_msd_fit():
+    rng = np.random.default_rng(3)
+    lengths = rng.integers(8, 120, size=60)
+    points = np.concatenate([_random_walk(length, seed=i) for i, length in enumerate(lengths)])
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    limit = 50
+    msd_y, _ = batch_msd(points, offsets, limit=limit)
+
+    alpha, d, fitted = batch_msd_fit(msd_y, delta=5.2, refine=50)
+    for i, length in enumerate(lengths):
+        n_lags = min(limit, length - 1)
+        expected_alpha, expected_y = basic_msd_fit(msd_y[i, :n_lags], delta=5.2)
+        np.testing.assert_allclose(alpha[i], expected_alpha, atol=1e-3)
+        np.testing.assert_allclose(fitted[i, :n_lags], expected_y, rtol=1e-3)
+
+    # less than 2 lags can not be fitted
+    alpha, _, _ = batch_msd_fit(np.array([[1.0, np.nan, np.nan]]), refine=50)
+    assert np.isnan(alpha[0])
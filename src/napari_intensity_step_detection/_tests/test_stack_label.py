@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+from napari_intensity_step_detection.utils.track_utils import (
+    get_statck_properties,
+)
+
+
+def test_stack_label_matches_per_frame_labelling():
+    rng = np.random.default_rng(0)
+    masks = rng.random((7, 48, 40)) > 0.75
+    # objects touching the frame borders, which must not connect across frames
+    masks[:, 0:4, 10:20] = True
+    masks[:, -4:, 10:20] = True
+    # an empty frame inside a chunk
+    masks[3] = False
+    images = rng.random(masks.shape) * 100
+
+    expected = get_statck_properties(masks, images)
+    for chunk_size in (3, 16):
+        result = get_statck_properties(masks, images, stack_label=True, chunk_size=chunk_size)
+        assert 3 not in set(result['frame'])
+        pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-10)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from napari_intensity_step_detection.utils.track_utils import (
+    get_frame_properties_columns,
+    get_statck_properties,
+)
+
+
+def _frames(n_frames=3, shape=(96, 80), seed=0):
+    rng = np.random.default_rng(seed)
+    masks = rng.random((n_frames,) + shape) > 0.7
+    # regions crossing the seams of 32 x 32 tiles, horizontally, vertically and on a corner
+    masks[:, 10:14, 20:50] = True
+    masks[:, 20:60, 40:43] = True
+    masks[:, 28:36, 60:68] = True
+    images = rng.random((n_frames,) + shape) * 100
+    return masks, images
+
+
+def test_tiled_frame_matches_untiled():
+    masks, images = _frames()
+    for backend in ('skimage', 'ndimage'):
+        untiled = get_frame_properties_columns(0, masks[0], images[0], backend=backend)
+        for tile_workers in (1, 3):
+            tiled = get_frame_properties_columns(0, masks[0], images[0], backend=backend, tile_shape=(32, 32),
+                                                 tile_workers=tile_workers)
+            assert list(tiled) == list(untiled)
+            for column in untiled:
+                np.testing.assert_allclose(tiled[column], untiled[column], rtol=1e-10, err_msg=column)
+
+
+def test_tiled_stack_matches_untiled():
+    masks, images = _frames(n_frames=5, seed=1)
+    untiled = get_statck_properties(masks, images, backend='ndimage')
+    tiled = get_statck_properties(masks, images, backend='ndimage', tile_shape=(32, 32), tile_workers=2,
+                                  n_workers=2, use_processes=False, chunk_size=2)
+    pd.testing.assert_frame_equal(tiled, untiled, check_exact=False, rtol=1e-10)
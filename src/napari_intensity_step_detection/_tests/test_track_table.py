@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+from napari_intensity_step_detection.base.track import (
+    filter_tracks_by_id,
+    pd_to_tracks,
+    tracks_to_napari_tracks,
+    tracks_to_tracks_meta,
+)
+from napari_intensity_step_detection.utils import basic_msd_fit
+
+
+def _tracked(n_tracks=40, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for track_id in rng.permutation(n_tracks) + 1:
+        length = rng.integers(2, 40)
+        frames = np.sort(rng.choice(60, size=length, replace=False))
+        position = rng.random(2) * 100 + np.cumsum(rng.normal(size=(length, 2)), axis=0)
+        rows.append(pd.DataFrame({'track_id': track_id, 'frame': frames, 'y': position[:, 0], 'x': position[:, 1],
+                                  'intensity_mean': rng.random(length) * 10, 'area': rng.integers(1, 9, length)}))
+    # rows of the tracks interleaved as the linking returns them
+    return pd.concat(rows, ignore_index=True).sample(frac=1, random_state=seed).sort_values('frame', kind='stable')
+
+
+def _reference_tracks(df, min_length=5, ignore_reagion=None):
+    # the former per track implementation: one DataFrame per track, sorted by frame
+    tracks = []
+    for _, track in df.groupby('track_id'):
+        track = track.sort_values('frame')
+        if len(track) < min_length:
+            continue
+        if ignore_reagion is not None:
+            (y0, x0), (y1, x1) = ignore_reagion
+            y, x = track[['y', 'x']].to_numpy()[0]
+            if min(y0, y1) <= y <= max(y0, y1) and min(x0, x1) <= x <= max(x0, x1):
+                continue
+        tracks.append(track)
+    return tracks
+
+
+def test_pd_to_tracks_matches_per_track_implementation():
+    df = _tracked()
+    region = ((20, 30), (70, 80))
+    for ignore_reagion in (None, region):
+        expected = _reference_tracks(df, ignore_reagion=ignore_reagion)
+        tracks = pd_to_tracks(df, min_length=5, ignore_reagion=ignore_reagion)
+        assert len(tracks) == len(expected)
+        for track, reference in zip(tracks, expected):
+            assert track.track_id == reference['track_id'].iloc[0]
+            assert track.length == len(reference)
+            np.testing.assert_array_equal(track.points, reference[['y', 'x']].to_numpy())
+            np.testing.assert_array_equal(track.frames, reference['frame'].to_numpy())
+            np.testing.assert_array_equal(track.intensity_mean, reference['intensity_mean'].to_numpy())
+            np.testing.assert_allclose(track.mean_intensity, reference['intensity_mean'].mean())
+            pd.testing.assert_frame_equal(track.to_pd(), reference)
+
+
+def test_tracks_to_napari_tracks_matches_per_track_implementation():
+    df = _tracked(seed=1)
+    expected = _reference_tracks(df)
+    napari_tracks, properties = tracks_to_napari_tracks(pd_to_tracks(df))
+    np.testing.assert_array_equal(
+        napari_tracks, np.concatenate([t[['track_id', 'frame', 'y', 'x']].to_numpy() for t in expected]))
+    assert list(properties) == ['intensity_mean', 'area']
+    for column, values in properties.items():
+        np.testing.assert_array_equal(values, np.concatenate([t[column].to_numpy() for t in expected]))
+
+
+def test_filter_tracks_by_id_matches_per_track_implementation():
+    df = _tracked(seed=2)
+    tracks = pd_to_tracks(df)
+    track_ids = [t.track_id for t in tracks][::3] + [-1]
+    filtered = filter_tracks_by_id(tracks, track_ids)
+    expected = [t for t in tracks if t.track_id in track_ids]
+    assert [t.track_id for t in filtered] == [t.track_id for t in expected]
+    for track, reference in zip(filtered, expected):
+        pd.testing.assert_frame_equal(track.to_pd(), reference.to_pd())
+
+
+def test_tracks_meta_matches_per_track_fit():
+    df = _tracked(seed=3)
+    expected = _reference_tracks(df)
+    tracks = pd_to_tracks(df, delta=5.2)
+    meta = tracks_to_tracks_meta(tracks)
+    np.testing.assert_array_equal(meta['length'], [len(t) for t in expected])
+    np.testing.assert_allclose(meta['mean_intensity'], [t['intensity_mean'].mean() for t in expected])
+    for track, reference, alpha in zip(tracks, expected, meta['msd_fit_alpha']):
+        # msd over the rows of the track, as Track.calculate_msd
+        points = reference[['y', 'x']].to_numpy()
+        lags = np.arange(1, min(100, len(points) - 1) + 1)
+        msd = np.array([np.mean(np.sum((points[lag:] - points[:-lag]) ** 2, axis=1)) for lag in lags])
+        np.testing.assert_allclose(alpha, basic_msd_fit(msd, delta=5.2)[0], atol=1e-3)
+        # the per track fit and the meta column use the same estimator
+        np.testing.assert_allclose(track.msd_fit()[0], alpha, rtol=1e-6)
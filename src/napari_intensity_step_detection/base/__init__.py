@@ -4,7 +4,7 @@ from .sliders import HFilterSlider, HRangeSlider
 from .plots import Histogram, IntensityStepPlots
 from .histogram_grid import HistogramGrid
 from ..filter_widget.properties_histogram import PropertiesHistogram
-from .track import Track
+from .track import Track, TrackTable
 
 __all__ = (
     "AppState",
@@ -12,5 +12,5 @@ __all__ = (
     "TrackMetaModel", "TrackMetaModelProxy",
     "HFilterSlider", "HRangeSlider",
     "PropertiesHistogram", "Histogram", "IntensityStepPlots", "HistogramGrid", "PropertiesHistogram",
-    "Track",
+    "Track", "TrackTable",
 )
@@ -34,177 +34,436 @@ def track_length_binning(tracks, bin_size=10, bin_column='length'):
     # return tracks
 
 
-def pd_to_tracks(df: pd.DataFrame, is_3d=False, delta=1, min_length=5, step_detection=False, ignore_reagion=None, progress=None):
-    tg = df.groupby('track_id', as_index=False, group_keys=True, dropna=True)
-    tracks = []
-    if progress is not None:
-        tg = progress(tg, desc="Creating to tracks")
-    for track_id, track in tg:
-        t = from_pd_track(track, delta=delta, is_3d=is_3d,
-                          step_detection=step_detection)
-        if t.length < min_length:
-            continue
-        if ignore_reagion is not None:
-            if t.is_in_bbox(ignore_reagion[0], ignore_reagion[1]):
-                continue
-        tracks.append(t)
-    return tracks
+def pd_to_tracks(df: pd.DataFrame, is_3d=False, delta=1, min_length=5, step_detection=False, ignore_reagion=None,
+                 progress=None, ignore_shapes=None):
+    # one sort of the whole table, the filters are masks over the tracks (progress is not needed any more)
+    # ignore_reagion is one (top_left, bottom_right) rectangle, ignore_shapes a list of polygons (shape_polygons)
+    table = TrackTable.from_pd(df, is_3d=is_3d, delta=delta, step_detection=step_detection)
+    keep = table.lengths >= min_length
+    if ignore_reagion is not None:
+        keep &= ~table.spatial_index().query_rectangle(ignore_reagion[0], ignore_reagion[1])
+    if ignore_shapes:
+        keep &= ~table.spatial_index().query(ignore_shapes)
+    return table.take(np.flatnonzero(keep))
+
+
+def as_track_table(tracks):
+    """
+    TrackTable of a TrackTable or of a list of Track views
+
+    Views on one table are gathered with TrackTable.take, other lists are rebuilt from their DataFrames.
+    """
+    if isinstance(tracks, TrackTable):
+        return tracks
+    tracks = list(tracks)
+    if len(tracks) == 0:
+        raise ValueError("No tracks")
+    table = tracks[0].table
+    if all(t.table is table for t in tracks):
+        return table.take([t.index for t in tracks])
+    return TrackTable.from_pd(pd.concat([t.to_pd() for t in tracks]), is_3d=table.is_3d, delta=table.delta,
+                              step_detection=table.is_step_detection)
 
 
 def tracks_to_pd(tracks):
-    df = pd.concat([t.to_pd() for t in tracks])
+    df = as_track_table(tracks).to_pd()
     return df
 
 
 def filter_tracks_by_id(tracks, track_ids):
-    return [t for t in tracks if t.track_id in track_ids]
+    return as_track_table(tracks).select(track_ids)
 
 
 def tracks_to_napari_tracks(tracks, progress=None):
-    napari_tracks = None
-    properties_columns = tracks[0].properties_columns
-    if progress is not None:
-        tracks = progress(tracks, desc="Converting tracks to napari tracks")
-    for track in tracks:
-        if napari_tracks is not None:
-            napari_tracks = np.concatenate(
-                (napari_tracks, track.napari_points))
-        else:
-            napari_tracks = track.napari_points
-        # napari_tracks.append(track.points)
-
-    properties = {}
-    tracks_df = tracks_to_pd(tracks)
-    _tracks_df = tracks_df[properties_columns]
-    properties = _tracks_df.to_dict()
-    properties = dict(
-        map(lambda kv: (kv[0], np.array(list(kv[1].values()))), properties.items()))
-
-    return np.array(napari_tracks), properties
-
-
-def tracks_to_tracks_meta(tracks, progress=None):
-    tracks_meta = []
-    if progress is not None:
-        tracks = progress(tracks, desc="Creating tracks meta data")
-    for track in tracks:
-        tracks_meta.append(track.meta())
-
-    meta_pd = pd.DataFrame(tracks_meta)
+    # the napari data is written column by column in one array, the properties are the table columns
+    table = as_track_table(tracks)
+    napari_tracks = np.empty((table.offsets[-1], 2 + table.points.shape[1]))
+    napari_tracks[:, 0] = table.columns['track_id']
+    napari_tracks[:, 1] = table.columns['frame']
+    napari_tracks[:, 2:] = table.points
+    properties = {c: table.columns[c] for c in table.properties_columns}
+    return napari_tracks, properties
+
+
+def tracks_to_tracks_meta(tracks, progress=None, columns=None):
+    # the meta columns are computed in batch on first use and cached in the table, see TrackTable.meta
+    meta_pd = as_track_table(tracks).meta(columns)
     return meta_pd
 
 
 def from_pd_track(df, is_3d=False, step_detection=False, delta=1):
-    if 'frame' not in df.columns:
-        raise ValueError("DataFrame does not have frame column")
-    if 'track_id' not in df.columns:
-        raise ValueError("DataFrame does not have track_id column")
-
-    if not is_3d:
-        if not all(x in df.columns for x in ['x', 'y']):
-            raise ValueError("DataFrame does not have x and y column")
-    else:
-        if not all(x in df.columns for x in ['x', 'y', 'z']):
-            raise ValueError("DataFrame does not have x, y and z column")
-
-    t = Track(delta=delta, is_3d=is_3d, is_step_detection=step_detection)
-    t.dataframe = df.sort_values(by=['frame'])
-    if is_3d:
-        t.points = df[['z', 'y', 'x']].to_numpy()
-        t.napari_points = df[['track_id', 'frame', 'z', 'y', 'x']].to_numpy()
-    else:
-        t.points = df[['y', 'x']].to_numpy()
-        t.napari_points = df[['track_id', 'frame', 'y', 'x']].to_numpy()
-
-    t.frames = df['frame'].to_numpy()
-    t.track_id = df['track_id'].to_numpy()[0]
-    _columns = list(df.columns)
-    _columns.remove('x')
-    _columns.remove('y')
-    if t.is_3d:
-        _columns.remove('z')
-    _columns.remove('frame')
-    _columns.remove('track_id')
-    t.properties_columns = _columns
-
-    # convert dict of dict to dict of np.array
-    # t.properties = dict(
-    #     map(lambda kv: (kv[0], np.array(list(kv[1].values()))), _properties.items()))
-
-    # Load additional attributes if provided
-    for col in _columns:
-        setattr(t, col, df[col].to_numpy())
-
-    t.length = len(t.points)
-    t.mean_intensity = np.nanmean(t.intensity())
-
-    return t
-
-
-class Track():
-    def __init__(self, delta=1, is_3d=False, is_step_detection=False):
+    return TrackTable.from_pd(df, is_3d=is_3d, delta=delta, step_detection=step_detection)[0]
+
+
+class TrackTable():
+    """
+    Columnar storage of many tracks
+
+    Every column is one array sorted by (track_id, frame) and the rows of the
+    i-th track are offsets[i]:offsets[i + 1], the positions are kept together in
+    points. Track objects are views on a table, so the memory stays the size of
+    the data and the batch operations are array operations.
+
+    params:
+        columns: dict of column name to np.ndarray sorted by (track_id, frame),
+            with the track_id, frame and position columns
+        offsets: np.ndarray first row of every track, followed by the number of rows
+        index: np.ndarray labels of the rows in the source DataFrame
+    """
+    META_COLUMNS = ('track_id', 'length', 'msd_fit_alpha', 'mean_intensity')
+    MSD_META_COLUMNS = ('msd_fit_alpha',)
+
+    def __init__(self, columns: dict, offsets: np.ndarray, is_3d=False, delta=1, is_step_detection=False,
+                 index=None):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        pos_columns = ['z', 'y', 'x'] if is_3d else ['y', 'x']
+        points = np.column_stack([columns[c] for c in pos_columns]) \
+            if offsets[-1] else np.zeros((0, len(pos_columns)))
+        self._init(points, {c: v for c, v in columns.items() if c not in pos_columns}, offsets,
+                   list(columns.keys()), np.arange(offsets[-1]) if index is None else index,
+                   is_3d=is_3d, delta=delta, is_step_detection=is_step_detection)
+
+    def _init(self, points, columns, offsets, column_names, index, is_3d=False, delta=1, is_step_detection=False,
+              msd_limit=100):
+        # every attribute of the table, shared by __init__ and take
         self.is_3d = is_3d
-        self.dataframe = None
-        self.points = None
-        self.napari_points = None
-        self.frames = None
+        self.is_step_detection = is_step_detection
         self.delta = delta
-        self.msd = None
-        self.msd_limit = 100
-        self.properties = None
-        self.subpixel_bias = None
-        self.length = None
-
-        # meta attributes
-        self.track_id = None
-        self.velocity = None
-        self.msd_fit_op = None
-
-    def to_pd(self):
-        return self.dataframe
+        self.offsets = offsets
+        self.column_names = column_names
+        self.points = points
+        self.columns = columns
+        self.index = index
+        self.properties_columns = [c for c in self.column_names
+                                   if c not in self.pos_columns and c not in ('frame', 'track_id')]
+        self.track_ids = self.columns['track_id'][self.offsets[:-1]]
+
+        self.msd_limit = msd_limit
+
+        # per track msd caches and meta columns, the msd ones are cleared when delta or msd_limit change
+        self._msd = {}
+        self._msd_fit = {}
+        self._meta = {}
+        self._track_index = None
+        self._spatial_index = None
+
+    @classmethod
+    def from_pd(cls, df: pd.DataFrame, is_3d=False, delta=1, step_detection=False):
+        """
+        Build the table from a tracked DataFrame with one sort of all the rows
+
+        params:
+            df: pd.DataFrame with track_id, frame, y, x (and z) columns
+
+        returns:
+            table: TrackTable
+        """
+        if 'frame' not in df.columns:
+            raise ValueError("DataFrame does not have frame column")
+        if 'track_id' not in df.columns:
+            raise ValueError("DataFrame does not have track_id column")
+        if not is_3d:
+            if not all(x in df.columns for x in ['x', 'y']):
+                raise ValueError("DataFrame does not have x and y column")
+        else:
+            if not all(x in df.columns for x in ['x', 'y', 'z']):
+                raise ValueError("DataFrame does not have x, y and z column")
+
+        df = df[df['track_id'].notna()]
+        track_id = df['track_id'].to_numpy()
+        order = np.lexsort((df['frame'].to_numpy(), track_id))
+        starts = np.flatnonzero(np.diff(track_id[order])) + 1
+        offsets = np.concatenate(([0], starts, [len(order)])) if len(order) else np.zeros(1, dtype=np.int64)
+        columns = {c: df[c].to_numpy()[order] for c in df.columns}
+        return cls(columns, offsets, is_3d=is_3d, delta=delta, is_step_detection=step_detection,
+                   index=df.index.to_numpy()[order])
+
+    @property
+    def pos_columns(self):
+        return ['z', 'y', 'x'] if self.is_3d else ['y', 'x']
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def column(self, name):
+        if name in self.pos_columns:
+            return self.points[:, self.pos_columns.index(name)]
+        return self.columns[name]
 
     def set_delta(self, delta):
         if delta == self.delta:
             return
         self.delta = delta
-        self.msd = None
-        self.msd_fit_op = None
+        self._clear_msd()
 
-    def calculate_msd(self, limit=100):
+    def set_msd_limit(self, limit):
+        if limit == self.msd_limit:
+            return
+        self.msd_limit = limit
+        self._clear_msd()
+
+    def _clear_msd(self):
+        self._msd.clear()
+        self._msd_fit.clear()
+        for name in TrackTable.MSD_META_COLUMNS:
+            self._meta.pop(name, None)
+
+    def meta_column(self, name):
+        """
+        Meta column of all the tracks, computed in batch on first use and cached
+
+        params:
+            name: one of TrackTable.META_COLUMNS
+
+        returns:
+            column: np.ndarray one value per track
+        """
+        if name not in TrackTable.META_COLUMNS:
+            raise ValueError(f"Unknown meta column {name}")
+        if name not in self._meta:
+            self._meta[name] = self._compute_meta(name)
+        return self._meta[name]
+
+    def _compute_meta(self, name):
+        if name == 'track_id':
+            return self.track_ids
+        if name == 'length':
+            return self.lengths
+        if name == 'mean_intensity':
+            if 'intensity_mean' not in self.columns or len(self) == 0:
+                return np.full(len(self), np.nan)
+            intensity = self.columns['intensity_mean'].astype(np.float64)
+            valid = ~np.isnan(intensity)
+            total = np.add.reduceat(np.where(valid, intensity, 0), self.offsets[:-1])
+            count = np.add.reduceat(valid, self.offsets[:-1])
+            return np.divide(total, count, out=np.full(len(self), np.nan), where=count > 0)
+        # all the tracks are fitted together with batch_msd_fit, refined to the least squares of
+        # basic_msd_fit, and the per track caches of the Track views are filled
+        self._batch_msd()
+        fit = np.flatnonzero(self.lengths >= 5)
+        alpha = np.full(len(self), np.nan)
+        if len(fit) == 0:
+            return alpha
+        msd = np.full((len(fit), self.msd_limit), np.nan)
+        for k, i in enumerate(fit.tolist()):
+            y = self._msd[i][:self.msd_limit]
+            msd[k, :len(y)] = y
+        alpha[fit], _, fitted = utils.batch_msd_fit(msd, delta=self.delta, refine=50)
+        for k, i in enumerate(fit.tolist()):
+            if i not in self._msd_fit:
+                self._msd_fit[i] = (alpha[i], fitted[k, :len(self._msd[i][:self.msd_limit])])
+        return alpha
+
+    def _batch_msd(self):
+        # msd of all the tracks missing from the cache with one batch_msd call
+        lengths = self.lengths
+        missing = [i for i in np.flatnonzero(lengths >= 5).tolist() if i not in self._msd]
+        if not missing:
+            return
+        msd, _ = utils.batch_msd(self.points, self.offsets, limit=self.msd_limit)
+        for i in missing:
+            self._msd[i] = msd[i, :min(self.msd_limit, lengths[i] - 1)]
+
+    def meta(self, columns=None):
+        """
+        Meta DataFrame of the tracks, only the requested columns are computed
+
+        params:
+            columns: list of meta columns, default TrackTable.META_COLUMNS
+
+        returns:
+            meta: pd.DataFrame one row per track
+        """
+        columns = TrackTable.META_COLUMNS if columns is None else columns
+        return pd.DataFrame({c: self.meta_column(c) for c in columns})
+
+    def take(self, positions):
+        """
+        Table of the tracks at positions, all the columns are gathered at once
+
+        params:
+            positions: np.ndarray positions of the tracks in this table
+
+        returns:
+            table: TrackTable
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        lengths = self.lengths[positions]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        rows = np.repeat(self.offsets[positions] - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+        table = TrackTable.__new__(TrackTable)
+        table._init(self.points[rows], {c: v[rows] for c, v in self.columns.items()}, offsets, self.column_names,
+                    self.index[rows], is_3d=self.is_3d, delta=self.delta, is_step_detection=self.is_step_detection,
+                    msd_limit=self.msd_limit)
+        # the caches follow the selected tracks
+        old = {p: i for i, p in enumerate(positions.tolist())}
+        table._msd = {old[p]: v for p, v in self._msd.items() if p in old}
+        table._msd_fit = {old[p]: v for p, v in self._msd_fit.items() if p in old}
+        table._meta = {c: v[positions] for c, v in self._meta.items()}
+        return table
+
+    @property
+    def track_index(self):
+        # track_id -> position of the track, built on first use
+        if self._track_index is None:
+            self._track_index = dict(zip(self.track_ids.tolist(), range(len(self))))
+        return self._track_index
+
+    def spatial_index(self):
+        # TrackSpatialIndex over the start points and bounding boxes of the tracks, built on first use
+        if self._spatial_index is None:
+            self._spatial_index = utils.TrackSpatialIndex.from_points(self.points, self.offsets)
+        return self._spatial_index
+
+    def track(self, track_id):
+        """
+        Track view of track_id
+
+        returns:
+            track: Track
+        """
+        if track_id not in self.track_index:
+            raise ValueError(f"No track with track_id {track_id}")
+        return Track(self, self.track_index[track_id])
+
+    def select(self, track_ids):
+        """
+        Table of the tracks with one of track_ids, in the order of this table
+
+        returns:
+            table: TrackTable
+        """
+        return self.take(np.flatnonzero(np.isin(self.track_ids, np.asarray(track_ids))))
+
+    def to_pd(self, rows=slice(None)):
+        return pd.DataFrame({c: self.column(c)[rows] for c in self.column_names}, index=self.index[rows])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Track index {i} out of range")
+        return Track(self, i)
+
+    def __iter__(self):
+        return (Track(self, i) for i in range(len(self)))
+
+
+class Track():
+    """
+    View on one track of a TrackTable
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: TrackTable, index: int):
+        self.table = table
+        self.index = index
+
+    @property
+    def _rows(self):
+        return slice(self.table.offsets[self.index], self.table.offsets[self.index + 1])
+
+    @property
+    def track_id(self):
+        return self.table.track_ids[self.index]
+
+    @property
+    def length(self):
+        return int(self.table.offsets[self.index + 1] - self.table.offsets[self.index])
+
+    @property
+    def is_3d(self):
+        return self.table.is_3d
+
+    @property
+    def delta(self):
+        return self.table.delta
+
+    @property
+    def points(self):
+        return self.table.points[self._rows]
+
+    @property
+    def frames(self):
+        return self.table.columns['frame'][self._rows]
+
+    @property
+    def napari_points(self):
+        rows = self._rows
+        napari_points = np.empty((self.length, 2 + self.table.points.shape[1]))
+        napari_points[:, 0] = self.table.columns['track_id'][rows]
+        napari_points[:, 1] = self.table.columns['frame'][rows]
+        napari_points[:, 2:] = self.table.points[rows]
+        return napari_points
+
+    @property
+    def properties_columns(self):
+        return self.table.properties_columns
+
+    @property
+    def dataframe(self):
+        return self.to_pd()
+
+    @property
+    def mean_intensity(self):
+        intensity = self.intensity()
+        return None if intensity is None else np.nanmean(intensity)
+
+    @property
+    def msd(self):
+        # computed on first use with the msd_limit of the table
+        if self.index not in self.table._msd:
+            self.calculate_msd(limit=self.table.msd_limit)
+        return self.table._msd.get(self.index)
+
+    @property
+    def msd_fit_op(self):
+        if self.index not in self.table._msd_fit:
+            self.msd_fit(limit=self.table.msd_limit)
+        return self.table._msd_fit.get(self.index)
+
+    def __getattr__(self, name):
+        # property columns, as the attributes of the former Track
+        if name in Track.__slots__:
+            raise AttributeError(name)
+        if name in self.table.properties_columns:
+            return self.table.columns[name][self._rows]
+        raise AttributeError(f"'Track' object has no attribute '{name}'")
+
+    def to_pd(self):
+        return self.table.to_pd(self._rows)
+
+    def set_delta(self, delta):
+        # delta is shared by all the tracks of the table
+        self.table.set_delta(delta)
+
+    def calculate_msd(self, limit=100, method='direct'):
         limit = min(limit, self.length - 1)
-        if (self.msd is not None) and (limit <= self.msd_limit):
-            return self.msd[:limit]  # return if already calculated
+        msd = self.table._msd.get(self.index)
+        if (msd is not None) and (limit <= len(msd)):
+            return msd[:limit]  # return if already calculated
 
-        self.msd_limit = limit
         pos = self.points
-        if len(self.points) < 5:
+        if len(pos) < 5:
             return None
-        pos_columns = ['x', 'y']
-        if self.is_3d:
-            pos_columns.append('z')
-        result_columns = ['<{}>'.format(p) for p in pos_columns] + \
-            ['<{}^2>'.format(p) for p in pos_columns]
-
-        lagtimes = np.arange(1, limit+1)
-        msd_list = []
-        for lt in lagtimes:
-            diff = pos[lt:] - pos[:-lt]
-            msd_list.append(np.concatenate((np.nanmean(diff, axis=0),
-                                            np.nanmean(diff**2, axis=0))))
-        result = pd.DataFrame(msd_list, columns=result_columns, index=lagtimes)
-        result['msd'] = result[result_columns[-len(pos_columns):]].sum(1)
-        self.msd = result['msd'].to_numpy()
-        return self.msd
+        self.table._msd[self.index] = utils.batch_msd(pos, [0, len(pos)], limit=limit, method=method)[0][0]
+        return self.table._msd[self.index]
 
     def msd_fit(self, limit=100):
-        if self.msd_fit_op is not None:
-            return self.msd_fit_op
+        if self.index in self.table._msd_fit:
+            return self.table._msd_fit[self.index]
         _msd = self.calculate_msd(limit=limit)
         if _msd is None:
             return [None, None]
-        self.msd_fit_op = utils.basic_msd_fit(
-            _msd, delta=self.delta, limit=limit)
-        return self.msd_fit_op
+        # same estimator as the msd_fit_alpha meta column, so the cached fits agree
+        alpha, _, fitted = utils.batch_msd_fit(_msd[None, :], delta=self.delta, refine=50)
+        self.table._msd_fit[self.index] = (alpha[0], fitted[0])
+        return self.table._msd_fit[self.index]
 
     def position_to_displacement(self):
         pos = self.points
@@ -218,7 +477,7 @@ class Track():
         return self.length / (self.frames[-1] * self.delta)
 
     def intensity(self, category='intensity_mean'):
-        if not hasattr(self, category):
+        if category not in self.table.properties_columns:
             return None
         return getattr(self, category)
 
@@ -241,7 +500,7 @@ class Track():
         meta = {}
         meta['track_id'] = self.track_id
         meta['length'] = self.length
-        meta['msd_fit_alpha'] = self.msd_fit()[0]
+        meta['msd_fit_alpha'] = self.msd_fit(limit=self.table.msd_limit)[0]
         meta['mean_intensity'] = self.mean_intensity
         # meta['number_of_steps'] = self.number_of_steps()
         return meta
@@ -257,7 +516,7 @@ class Track():
             'track_id': self.track_id,
             'length': self.length,
             'mean_intensity': self.mean_intensity,
-            'msd_fit_alpha': self.msd_fit()[0],
+            'msd_fit_alpha': self.msd_fit(limit=self.table.msd_limit)[0],
             'number_of_steps': self.number_of_steps()
         }
 
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from napari.utils import progress
 import numpy as np
@@ -180,17 +181,6 @@ class TracksOverview(QWidget):
         self.length_intensity_hist.draw()
 
 
-def _get_shape_layer_data(shape_layer):
-    if shape_layer is None:
-        return None
-    shape_layer_data = shape_layer.data[0] if isinstance(
-        shape_layer.data, list) else shape_layer.data
-    shape_layer_data = shape_layer_data[:, 1:3]
-    top_left = shape_layer_data[0]
-    bottom_right = shape_layer_data[2]
-    return top_left, bottom_right
-
-
 class Tracking(QWidget):
 
     def __init__(self, base, parent: QWidget = None):
@@ -200,6 +190,8 @@ class Tracking(QWidget):
             'tracking_widget.ui')
         utils.load_ui(UI_FILE, self)
         self.base = base
+        # frames measured in a previous run are reused when tracking again, up to 256 MB
+        self.properties_cache = utils.FramePropertiesCache(max_bytes=256 * 2 ** 20)
 
         self.sbSearchRange.setValue(2)
         self.sbMemory.setValue(1)
@@ -207,6 +199,7 @@ class Tracking(QWidget):
         self.sbMinLength.setValue(5)
         self.sbMinLength.setMinimum(5)
         self.cbStepDetection.setChecked(False)
+        self.cbPredict.setChecked(False)
 
         def ifStepDetection(checked):
             if checked == 1:
@@ -283,6 +276,7 @@ class Tracking(QWidget):
         filtered_tracks = filter_tracks_by_id(all_tracks, filtered_track_ids)
 
         napari_tracks, properties = tracks_to_napari_tracks(filtered_tracks)
+        # the meta columns computed for all the tracks follow the selection, nothing is computed again
         filtered_tracks_meta = tracks_to_tracks_meta(filtered_tracks)
 
         utils.add_to_viewer(self.base.napari_viewer, current_track_layer.name, napari_tracks, "tracks",
@@ -301,24 +295,28 @@ class Tracking(QWidget):
         mask = self.base.get_layer('Label').data
         search_range = float(self.sbSearchRange.value())
         memory = int(self.sbMemory.value())
+        predict = self.cbPredict.isChecked()
         pbr = progress(total=100, desc="Tracking")
 
+        # the ndimage backend releases the GIL, a few threads avoid starting processes from the GUI
         main_pd_frame = utils.get_statck_properties(
-            masks=mask, images=image, show_progress=False)
+            masks=mask, images=image, show_progress=False, n_workers=min(4, os.cpu_count() or 1),
+            use_processes=False, cache=self.properties_cache, backend='ndimage')
 
         pbr.update(10)
 
         tracked_df = utils.get_tracks(
-            main_pd_frame, search_range=search_range, memory=memory)
+            main_pd_frame, search_range=search_range, memory=memory, predict=predict)
         # column name change from particle to track_id
         tracked_df.rename(columns={'particle': 'track_id'}, inplace=True)
-        bounds = _get_shape_layer_data(self.base.get_layer('Shape'))
+        ignore_shapes = utils.shape_polygons(self.base.get_layer('Shape'))
         self.tracks = pd_to_tracks(tracked_df, is_3d=False,
-                                   delta=self.sbDelta.value(), min_length=int(self.sbMinLength.value()), step_detection=self.cbStepDetection.isChecked(), ignore_reagion=bounds, progress=progress)
+                                   delta=self.sbDelta.value(), min_length=int(self.sbMinLength.value()), step_detection=self.cbStepDetection.isChecked(), ignore_shapes=ignore_shapes, progress=progress)
         tracks = self.tracks
         print("Total Tracks", len(tracks))
         napari_tracks, properties = tracks_to_napari_tracks(
             tracks, progress=progress)
+        # every meta column is computed in batch through TrackTable.meta_column and cached in the table
         track_meta = tracks_to_tracks_meta(tracks, progress=progress)
 
         print('std_alpha', track_meta['msd_fit_alpha'].sem())
@@ -339,7 +337,8 @@ class Tracking(QWidget):
                                 'all_tracks': tracks,
                                 'tracking_params': {
                                     "search_range": search_range,
-                                    "memory": memory
+                                    "memory": memory,
+                                    "predict": predict
                                 }
                             }
                             )
@@ -375,7 +374,7 @@ class Tracking(QWidget):
 
         track_id = int(float(track_id.strip()))
 
-        track = filter_tracks_by_id(self.tracks, [track_id])[0]
+        track = self.tracks.track(track_id)
         self.quickAnalysisView.set_traget_track(track)
 
         utils.add_to_viewer(self.base.napari_viewer, "Selected Track", track.napari_points, "tracks",
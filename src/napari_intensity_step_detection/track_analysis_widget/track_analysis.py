@@ -6,6 +6,7 @@ import warnings
 from napari_intensity_step_detection import utils
 import numpy as np
 from .tracking_plots import TrackAnalysisResult
+from napari_intensity_step_detection.base.track import tracks_to_pd
 from collections import OrderedDict
 import os
 import sys
@@ -51,6 +52,9 @@ class TrackAnalysis(NLayerWidget):
             print("Using filtered tracks")
             track_meta = track_layer.metadata['filter_meta']
             all_tracks = track_layer.metadata['filter_tracks']
+        # the tracking panel stores a TrackTable, the tracks reader a DataFrame
+        if not isinstance(all_tracks, pd.DataFrame):
+            all_tracks = tracks_to_pd(all_tracks)
 
         result_dict = {}
         all_alfa = {}
@@ -58,21 +62,17 @@ class TrackAnalysis(NLayerWidget):
         self.save_pd(track_meta, "track_meta")
         self.save_pd(all_tracks, "all_tracks")
 
-        def _get_shape_layer_data(shape_layer):
-            if shape_layer is None:
-                return None
-            shape_layer_data = shape_layer.data[0] if isinstance(
-                shape_layer.data, list) else shape_layer.data
-            shape_layer_data = shape_layer_data[:, 1:3]
-            top_left = shape_layer_data[0]
-            bottom_right = shape_layer_data[2]
-            return top_left, bottom_right
-
-        def _is_track_in_box(point, top_left, bottom_right):
-            return ((top_left[0] <= point[0] <= bottom_right[0])
-                    or (top_left[0] >= point[0] >= bottom_right[0])) \
-                and ((top_left[1] <= point[1] <= bottom_right[1])
-                     or (top_left[1] >= point[1] >= bottom_right[1]))
+        # tracks one after the other, sorted by frame, with the msd of all of them in one batch
+        tracks_sorted, offsets, all_msd, n_lags = utils.tracks_msd(all_tracks, limit=26)
+        track_ids = tracks_sorted['track_id'].to_numpy()
+        first = offsets[:-1]
+
+        # tracks starting in any of the shapes are excluded, with one query of all the tracks
+        excluded = set()
+        polygons = utils.shape_polygons(self.get_layer('Shape'))
+        if polygons:
+            starts = tracks_sorted[['y', 'x']].to_numpy()[first]
+            excluded = set(track_ids[first][utils.TrackSpatialIndex(starts).query(polygons)])
 
         # track length
         result_dict['lifetime_histogram'] = {
@@ -112,27 +112,16 @@ class TrackAnalysis(NLayerWidget):
         # msd
 
         msd_data = []
-        tg = all_tracks.groupby(
-            'track_id', as_index=False, group_keys=True, dropna=True)
-        for name, group in tg:
-            track = group[['x', 'y', 'intensity_mean', 'frame']
-                          ].sort_values('frame')
-            _track = track.to_numpy()
-
+        all_fit_alfa, _, all_fit = utils.batch_msd_fit(all_msd, delta=5.2, refine=50)
+        for i, name in enumerate(track_ids[first]):
             # filter track
-            bounds = _get_shape_layer_data(self.get_layer('Shape'))
-            if bounds is not None:
-                if _is_track_in_box(_track[0], bounds[0], bounds[1]):
-                    continue
+            if name in excluded:
+                continue
             # /filter track
 
-            pos = track.set_index('frame')[['x', 'y']]
-            pos = pos.reindex(np.arange(pos.index[0], 1 + pos.index[-1]))
-            result = utils.msd(pos.values, limit=26)
-
-            y = result.to_numpy()
+            y = all_msd[i, :n_lags[i]]
             x = np.arange(0, len(y)) * 5.2
-            alfa, _y = utils.basic_msd_fit(y, delta=5.2)
+            alfa, _y = all_fit_alfa[i], all_fit[i, :n_lags[i]]
             all_alfa[name] = alfa
             if alfa > 2.0:
                 print(f"Track {name} alfa {alfa}")
@@ -4,7 +4,13 @@ from .plot_utils import histogram, normalizeData, msd_alfa_plot
 from .setmentation_utils import draw_points, remove_small_objects, quick_log
 from .step_detection import FindSteps
 from .track_utils import TrackLabels, get_frame_position_properties, get_statck_properties, get_tracks, \
-    pd_to_napari_tracks, napari_track_to_pd, msd_old, msd_fit_function, msd_fit_velocity_function, basic_msd_fit, msd
+    FramePropertiesBuilder, get_frame_properties_columns, iter_stack_properties, FramePropertiesCache, link_parameter_sweep, \
+    pd_to_napari_tracks, napari_track_to_pd, msd_old, msd_fit_function, msd_fit_velocity_function, basic_msd_fit, msd, batch_msd, \
+    batch_msd_fit, tracks_msd
+from .linking import link_partitioned, iter_tracks, link_kdtree, KDTreeLinker, sparse_assignment, \
+    IncrementalLinker, close_gaps, VelocityKDTreeLinker, TrackVelocityPredict
+from .label_statistics import label_statistics, tiled_label_statistics, background_statistics
+from .spatial_index import TrackSpatialIndex, shape_polygons
 from .ui_utils import get_icon, load_ui
 
 __all__ = [
@@ -18,16 +24,38 @@ __all__ = [
     "TrackLabels",
     "get_frame_position_properties",
     "get_statck_properties",
+    "iter_stack_properties",
+    "label_statistics",
+    "tiled_label_statistics",
+    "background_statistics",
+    "link_partitioned",
+    "iter_tracks",
+    "link_kdtree",
+    "KDTreeLinker",
+    "IncrementalLinker",
+    "close_gaps",
+    "VelocityKDTreeLinker",
+    "TrackVelocityPredict",
+    "sparse_assignment",
+    "TrackSpatialIndex",
+    "shape_polygons",
+    "FramePropertiesCache",
+    "FramePropertiesBuilder",
+    "get_frame_properties_columns",
     "get_tracks",
+    "link_parameter_sweep",
     "get_icon",
     "quick_log",
     "load_ui",
     "pd_to_napari_tracks",
     "napari_track_to_pd",
     "msd",
+    "batch_msd",
     "msd_fit_function",
     "msd_fit_velocity_function",
     "basic_msd_fit",
+    "batch_msd_fit",
+    "tracks_msd",
     "normalizeData",
     "msd_old"
 ]
@@ -0,0 +1,291 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage import measure
+from skimage.segmentation import expand_labels
+
+
+def label_statistics(labels: np.ndarray, image: np.ndarray = None) -> dict:
+    """
+    Vectorized replacement of measure.regionprops_table for the
+    label, centroid, intensity_mean, intensity_max, intensity_min and area properties
+
+    Every statistic is a bincount or a labelled ndimage reduction over the
+    foreground pixels, so all the regions are measured in a few array passes
+    instead of one Python object per region.
+    labels can also hold a batch of frames (T, Y, X) as long as the labels
+    are unique over the batch, centroid-0 is then the frame of the region.
+
+    params:
+        labels: np.ndarray of integer labels, 0 is background
+        image: np.ndarray intensity image with the shape of labels, or with an
+            extra trailing channel axis in which case the intensity keys get a
+            -<channel> suffix as in regionprops_table
+
+    returns:
+        properties: dict with the same keys, order and dtypes as regionprops_table
+    """
+    labels = np.asarray(labels)
+    flat = labels.ravel()
+    foreground = np.flatnonzero(flat > 0)
+    lab = flat[foreground].astype(np.intp)
+
+    area = np.bincount(lab)
+    index = np.flatnonzero(area)
+    count = area[index].astype(np.float64)
+
+    properties = {'label': index.astype(np.int64)}
+    for d, coords in enumerate(np.unravel_index(foreground, labels.shape)):
+        properties[f'centroid-{d}'] = np.bincount(lab, weights=coords, minlength=len(area))[index] / count
+
+    if image is not None:
+        image = np.asarray(image)
+        multichannel = image.ndim == labels.ndim + 1
+        channels = image.reshape(-1, image.shape[-1]).T if multichannel else [image.ravel()]
+        intensity = {'intensity_mean': [], 'intensity_max': [], 'intensity_min': []}
+        for channel in channels:
+            values = channel[foreground].astype(np.float64)
+            intensity['intensity_mean'].append(np.bincount(lab, weights=values, minlength=len(area))[index] / count)
+            if len(index):
+                intensity['intensity_max'].append(np.asarray(ndimage.maximum(values, lab, index), dtype=np.float64))
+                intensity['intensity_min'].append(np.asarray(ndimage.minimum(values, lab, index), dtype=np.float64))
+            else:
+                intensity['intensity_max'].append(np.zeros(0))
+                intensity['intensity_min'].append(np.zeros(0))
+        for key, values in intensity.items():
+            if multichannel:
+                properties.update({f'{key}-{c}': v for c, v in enumerate(values)})
+            else:
+                properties[key] = values[0]
+
+    properties['area'] = count
+    return properties
+
+
+def background_statistics(labels: np.ndarray, image: np.ndarray, index: np.ndarray, intensity_mean: list,
+                          annulus=(2, 6), statistic: str = 'median', batch: bool = False) -> dict:
+    """
+    Local background around every labelled object, from an annulus of pixels
+    between annulus[0] and annulus[1] pixels away from the object
+
+    The annuli of all the objects come from two expand_labels of the label image,
+    pixels closer than annulus[0] to any object are left out and the others go to
+    the nearest object, then the statistics are labelled reductions as in label_statistics.
+
+    params:
+        labels: np.ndarray of integer labels, 0 is background
+        image: np.ndarray intensity image, optionally with a trailing channel axis
+        index: labels to report, as returned in label_statistics 'label'
+        intensity_mean: list of the intensity_mean of the objects, one array per channel
+        annulus: (inner, outer) distances of the annulus in pixels
+        statistic: 'median' or 'mean' of the annulus used as background
+        batch: the first axis of labels is a batch of frames, annuli are not grown along it
+
+    returns:
+        properties: dict with background, background_std, intensity_mean_bg
+            (intensity_mean - background) and snr (intensity_mean_bg / background_std),
+            keys get a -<channel> suffix for multi channel images, nan when an object has no annulus
+    """
+    if statistic not in ('median', 'mean'):
+        raise ValueError(f"Unknown background statistic {statistic}")
+    inner, outer = annulus
+    labels = np.asarray(labels)
+    if batch:
+        inner_labels = np.stack([expand_labels(f, inner) for f in labels])
+        outer_labels = np.stack([expand_labels(f, outer) for f in labels])
+    else:
+        inner_labels = expand_labels(labels, inner)
+        outer_labels = expand_labels(labels, outer)
+    ring = np.flatnonzero(((outer_labels > 0) & (inner_labels == 0)).ravel())
+    ring_labels = outer_labels.ravel()[ring].astype(np.intp)
+
+    n = int(max(index.max(initial=0), ring_labels.max(initial=0))) + 1
+    count = np.bincount(ring_labels, minlength=n)[index].astype(np.float64)
+    channels = _intensity_channels(image, labels.ndim)
+    properties = {'background': [], 'background_std': [], 'intensity_mean_bg': [], 'snr': []}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for values, mean in zip(channels, intensity_mean):
+            values = values[ring].astype(np.float64)
+            bg_mean = np.bincount(ring_labels, weights=values, minlength=n)[index] / count
+            bg_square = np.bincount(ring_labels, weights=values ** 2, minlength=n)[index] / count
+            bg_std = np.sqrt(np.maximum(bg_square - bg_mean ** 2, 0))
+            if statistic == 'median' and len(index):
+                background = np.asarray(ndimage.median(values, ring_labels, index), dtype=np.float64)
+                background[count == 0] = np.nan
+            else:
+                background = bg_mean
+            properties['background'].append(background)
+            properties['background_std'].append(bg_std)
+            properties['intensity_mean_bg'].append(mean - background)
+            properties['snr'].append((mean - background) / bg_std)
+
+    multichannel = np.ndim(image) == labels.ndim + 1
+    result = {}
+    for key, values in properties.items():
+        if multichannel:
+            result.update({f'{key}-{c}': v for c, v in enumerate(values)})
+        else:
+            result[key] = values[0]
+    return result
+
+
+def _intensity_channels(image: np.ndarray, ndim: int) -> list:
+    # flat intensity values per channel, the channel axis is the trailing one
+    image = np.asarray(image)
+    if image.ndim == ndim + 1:
+        return list(image.reshape(-1, image.shape[-1]).T)
+    return [image.ravel()]
+
+
+def _tile_partials(mask, image, core: tuple, shape: tuple, generate_label: bool):
+    # label one tile extended by a one pixel halo on its upper sides and reduce its core pixels
+    ext = tuple(slice(c.start, min(c.stop + 1, n)) for c, n in zip(core, shape))
+    tile = np.asarray(mask[ext])
+    tile_labels = measure.label(tile) if generate_label else tile.astype(np.int64)
+    core_in_ext = tuple(slice(0, c.stop - c.start) for c in core)
+    core_labels = tile_labels[core_in_ext]
+
+    foreground = np.flatnonzero(core_labels.ravel() > 0)
+    lab = core_labels.ravel()[foreground]
+    coords = [local + c.start for local, c in zip(np.unravel_index(foreground, core_labels.shape), core)]
+    index, inverse = np.unique(lab, return_inverse=True)
+    rows = np.arange(len(index))
+
+    partials = {
+        'label': index,
+        'count': np.bincount(inverse, minlength=len(index)).astype(np.float64),
+        'coords': [np.bincount(inverse, weights=c, minlength=len(index)) for c in coords],
+        'first': np.asarray(ndimage.minimum(np.ravel_multi_index(coords, shape), inverse, rows), dtype=np.int64)
+        if len(index) else np.zeros(0, dtype=np.int64),
+        'sum': [], 'max': [], 'min': [],
+    }
+    if image is not None:
+        for values in _intensity_channels(image[core], len(shape)):
+            values = values[foreground].astype(np.float64)
+            partials['sum'].append(np.bincount(inverse, weights=values, minlength=len(index)))
+            partials['max'].append(np.asarray(ndimage.maximum(values, inverse, rows), dtype=np.float64)
+                                   if len(index) else np.zeros(0))
+            partials['min'].append(np.asarray(ndimage.minimum(values, inverse, rows), dtype=np.float64)
+                                   if len(index) else np.zeros(0))
+
+    if generate_label:
+        # the halo pixels belong to the core of the next tiles, which see them in
+        # their lower border shell, matching both labels of a pixel stitches the objects
+        halo = np.ones(tile_labels.shape, dtype=bool)
+        halo[core_in_ext] = False
+        halo &= tile_labels > 0
+        shell = np.zeros(core_labels.shape, dtype=bool)
+        for d in range(len(shape)):
+            shell[(slice(None),) * d + (0,)] = True
+        shell &= core_labels > 0
+        halo_coords = [local + e.start for local, e in zip(np.nonzero(halo), ext)]
+        shell_coords = [local + c.start for local, c in zip(np.nonzero(shell), core)]
+        partials['halo'] = (np.ravel_multi_index(halo_coords, shape), tile_labels[halo])
+        partials['shell'] = (np.ravel_multi_index(shell_coords, shape), core_labels[shell])
+    return partials, int(tile_labels.max(initial=0))
+
+
+def tiled_label_statistics(mask: np.ndarray, image: np.ndarray = None, tile_shape=(1024, 1024),
+                           generate_label: bool = True, n_workers: int = 1) -> dict:
+    """
+    label_statistics of measure.label(mask) computed tile by tile
+
+    Every tile is labelled with a one pixel halo into its neighbours, objects cut
+    by the tile borders are joined through the labels the halo pixels get in both
+    tiles and the partial sums of the tiles are reduced per object. Labels follow
+    the raster order of measure.label, so the result is the same as the untiled
+    one while only one tile per worker is held in memory.
+
+    params:
+        mask: np.ndarray binary mask, or labels if generate_label is False
+        image: np.ndarray intensity image, optionally with a trailing channel axis
+        tile_shape: shape of the tiles
+        n_workers: number of tiles labelled concurrently
+
+    returns:
+        properties: dict with the same keys, order and dtypes as label_statistics
+    """
+    shape = tuple(mask.shape)
+    tile_shape = tuple(tile_shape)[-len(shape):]
+    tile_shape = (1,) * (len(shape) - len(tile_shape)) + tile_shape
+    cores = [tuple(slice(s, min(s + t, n)) for s, t, n in zip(starts, tile_shape, shape))
+             for starts in itertools.product(*[range(0, n, t) for n, t in zip(shape, tile_shape)])]
+
+    def _partials(core):
+        return _tile_partials(mask, image, core, shape, generate_label)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            tiles = list(executor.map(_partials, cores))
+    else:
+        tiles = [_partials(core) for core in cores]
+
+    # tile labels made unique over the frame
+    offset = 0
+    for partials, n_labels in tiles:
+        if generate_label:
+            partials['label'] = partials['label'] + offset
+            partials['halo'] = (partials['halo'][0], partials['halo'][1] + offset)
+            partials['shell'] = (partials['shell'][0], partials['shell'][1] + offset)
+            offset += n_labels
+    tiles = [partials for partials, _ in tiles]
+
+    def _cat(key, channel=None):
+        if channel is None:
+            return np.concatenate([t[key] for t in tiles])
+        return np.concatenate([t[key][channel] for t in tiles])
+
+    labels = _cat('label')
+    if generate_label:
+        shell_index = np.concatenate([t['shell'][0] for t in tiles])
+        shell_label = np.concatenate([t['shell'][1] for t in tiles])
+        halo_index = np.concatenate([t['halo'][0] for t in tiles])
+        halo_label = np.concatenate([t['halo'][1] for t in tiles])
+        order = np.argsort(shell_index)
+        matched = shell_label[order][np.searchsorted(shell_index[order], halo_index)]
+        graph = coo_matrix((np.ones(len(halo_label)), (halo_label, matched)), shape=(offset + 1, offset + 1))
+        _, component = connected_components(graph, directed=False)
+        labels = component[labels]
+
+    index, inverse = np.unique(labels, return_inverse=True)
+    rows = np.arange(len(index))
+    count = np.bincount(inverse, weights=_cat('count'), minlength=len(index)).astype(np.float64)
+    if generate_label and len(index):
+        # measure.label numbers the objects in raster order of their first pixel
+        first = np.asarray(ndimage.minimum(_cat('first'), inverse, rows))
+        order = np.argsort(first)
+        index = np.arange(1, len(index) + 1)
+    else:
+        order = rows
+
+    properties = {'label': index.astype(np.int64)}
+    for d in range(len(shape)):
+        coords = np.bincount(inverse, weights=_cat('coords', d), minlength=len(index))
+        properties[f'centroid-{d}'] = (coords / count)[order]
+
+    if image is not None:
+        n_channels = len(tiles[0]['sum'])
+        intensity = {'intensity_mean': [], 'intensity_max': [], 'intensity_min': []}
+        for c in range(n_channels):
+            sums = np.bincount(inverse, weights=_cat('sum', c), minlength=len(index))
+            intensity['intensity_mean'].append((sums / count)[order])
+            if len(index):
+                intensity['intensity_max'].append(
+                    np.asarray(ndimage.maximum(_cat('max', c), inverse, rows), dtype=np.float64)[order])
+                intensity['intensity_min'].append(
+                    np.asarray(ndimage.minimum(_cat('min', c), inverse, rows), dtype=np.float64)[order])
+            else:
+                intensity['intensity_max'].append(np.zeros(0))
+                intensity['intensity_min'].append(np.zeros(0))
+        multichannel = image.ndim == len(shape) + 1
+        for key, values in intensity.items():
+            if multichannel:
+                properties.update({f'{key}-{c}': v for c, v in enumerate(values)})
+            else:
+                properties[key] = values[0]
+
+    properties['area'] = count[order]
+    return properties
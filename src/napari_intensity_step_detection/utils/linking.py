@@ -0,0 +1,521 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import trackpy
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+from scipy.spatial import cKDTree
+
+try:
+    # trackpy internals driven level by level by IncrementalLinker, not part of the trackpy API
+    from trackpy.linking.linking import Linker
+    from trackpy.linking.utils import Point, TrackUnstored
+except ImportError:
+    Linker = Point = TrackUnstored = None
+
+
+def _link_tile(frames: np.ndarray, positions: np.ndarray, pos_columns: list, search_range: float,
+               memory: int) -> np.ndarray:
+    # worker of link_partitioned, kept at module level so it can be pickled
+    trackpy.quiet()
+    df = pd.DataFrame(positions, columns=pos_columns)
+    df['frame'] = frames
+    linked = trackpy.link(f=df, search_range=search_range, memory=memory, pos_columns=pos_columns)
+    return linked.sort_index()['particle'].to_numpy()
+
+
+def tracks_from_predecessors(frames: np.ndarray, positions: np.ndarray, predecessor: np.ndarray) -> np.ndarray:
+    """
+    Track ids from the predecessor (row of the previous point of the track, -1 at the start) of every row
+
+    Rows claimed as predecessor by several rows keep only the closest one,
+    so every row has at most one successor and the tracks are simple chains.
+
+    returns:
+        particle: np.ndarray track id per row, numbered in order of the first frame of the tracks
+    """
+    n = len(frames)
+    predecessor = predecessor.copy()
+    linked = np.flatnonzero(predecessor >= 0)
+    distance = np.sum((positions[linked] - positions[predecessor[linked]]) ** 2, axis=1)
+    order = np.lexsort((distance, predecessor[linked]))
+    claims = predecessor[linked][order]
+    duplicated = np.concatenate(([False], claims[1:] == claims[:-1]))
+    predecessor[linked[order][duplicated]] = -1
+
+    linked = np.flatnonzero(predecessor >= 0)
+    graph = coo_matrix((np.ones(len(linked)), (linked, predecessor[linked])), shape=(n, n))
+    _, component = connected_components(graph, directed=False)
+    # renumber the tracks in order of their first point, as trackpy does
+    first = np.full(component.max(initial=-1) + 1, n, dtype=np.int64)
+    rows = np.lexsort((np.arange(n), frames))
+    np.minimum.at(first, component[rows], np.arange(n))
+    return np.argsort(np.argsort(first))[component]
+
+
+def link_partitioned(df: pd.DataFrame, search_range: float = 2, memory: int = 0, tile_shape=(256, 256),
+                     overlap: float = None, n_workers: int = None, pos_columns: list = None) -> pd.DataFrame:
+    """
+    trackpy.link over overlapping spatial tiles linked in parallel processes
+
+    Every tile is linked with its surrounding overlap, each detection keeps the
+    link to its previous point from the tile that owns it (the tile whose core holds it)
+    and the links are chained into tracks across the tile borders.
+    The detections are grouped into the same tracks as by a global trackpy.link
+    as long as the objects move less than the overlap while they are in the border
+    zone. The track ids are not trackpy's, they are numbered in order of the first
+    point of the tracks.
+
+    params:
+        df: pd.DataFrame detections with frame and position columns
+        tile_shape: core size of the tiles along pos_columns
+        overlap: width added around every tile, default 4 * search_range * (memory + 1)
+        n_workers: number of processes, None uses all the cores
+        pos_columns: position columns, default ['y', 'x'] (['z', 'y', 'x'] if there is a z column)
+
+    returns:
+        df: pd.DataFrame sorted by frame with a particle column
+    """
+    if pos_columns is None:
+        pos_columns = ['z', 'y', 'x'] if 'z' in df.columns else ['y', 'x']
+    if overlap is None:
+        overlap = 4 * search_range * (memory + 1)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    tile_shape = np.broadcast_to(np.asarray(tile_shape, dtype=np.float64)[-len(pos_columns):], len(pos_columns))
+
+    df = df.sort_values('frame', kind='stable')
+    frames = df['frame'].to_numpy().astype(np.int64)
+    positions = df[pos_columns].to_numpy(dtype=np.float64)
+    origin = positions.min(axis=0) if len(positions) else np.zeros(len(pos_columns))
+    owner = np.floor((positions - origin) / tile_shape).astype(np.int64)
+    n_tiles = owner.max(axis=0) + 1 if len(positions) else np.zeros(len(pos_columns), dtype=np.int64)
+
+    tiles = []
+    for tile in itertools.product(*[range(n) for n in n_tiles]):
+        low = origin + np.asarray(tile) * tile_shape - overlap
+        high = low + tile_shape + 2 * overlap
+        rows = np.flatnonzero(np.all((positions >= low) & (positions < high), axis=1))
+        if len(rows):
+            tiles.append((np.asarray(tile), rows))
+
+    predecessor = np.full(len(df), -1, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        futures = [executor.submit(_link_tile, frames[rows], positions[rows], pos_columns, search_range, memory)
+                   for _, rows in tiles]
+        for (tile, rows), future in zip(tiles, futures):
+            particle = future.result()
+            # previous point of every row along the tile tracks (rows are frame sorted)
+            order = np.lexsort((frames[rows], particle))
+            sorted_rows = rows[order]
+            same = np.concatenate(([False], particle[order][1:] == particle[order][:-1]))
+            owned = np.all(owner[sorted_rows] == tile, axis=1)
+            keep = same & owned
+            predecessor[sorted_rows[keep]] = sorted_rows[np.flatnonzero(keep) - 1]
+
+    df = df.copy()
+    df['particle'] = tracks_from_predecessors(frames, positions, predecessor)
+    return df
+
+
+def _iter_frames(detections):
+    # chunks of detections (one or more frames each, in frame order) to one DataFrame per frame
+    for chunk in detections:
+        for _, frame in chunk.groupby('frame', sort=True):
+            yield frame
+
+
+def iter_tracks(detections, search_range: float = 2, memory: int = 0, pos_columns: list = None,
+                show_progress: bool = False):
+    """
+    Streaming version of get_tracks
+
+    Detections are consumed chunk by chunk, for example straight from
+    iter_stack_properties, and linked with trackpy.link_df_iter which only keeps
+    the last memory + 1 frames, so the detection table is never materialized.
+
+    params:
+        detections: iterable of pd.DataFrame in frame order, each with one or more frames
+        search_range: maximum displacement between two frames
+        memory: number of frames a particle can vanish and still be linked
+        pos_columns: position columns, guessed by trackpy by default
+
+    yields:
+        df: pd.DataFrame of one frame with the particle column
+    """
+    trackpy.quiet((not show_progress))
+    yield from trackpy.link_df_iter(_iter_frames(detections), search_range, memory=memory, pos_columns=pos_columns)
+
+
+def sparse_assignment(source: np.ndarray, target: np.ndarray, cost: np.ndarray, n_source: int, n_target: int,
+                      no_link_cost: float) -> tuple:
+    """
+    Minimum cost assignment between sources and targets over sparse candidate pairs,
+    every source and target can also stay unassigned for no_link_cost
+
+    The candidates are augmented with the no link and the transposed dummy blocks
+    (Jaqaman et al. 2008) so a full matching always exists and the whole problem
+    is solved by one min_weight_full_bipartite_matching call.
+
+    params:
+        source, target: np.ndarray indices of the candidate pairs
+        cost: np.ndarray cost of every candidate pair
+
+    returns:
+        source, target: np.ndarray indices of the assigned pairs
+    """
+    n = len(source)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # zero weights would be dropped as non edges, every weight is shifted by a small epsilon
+    eps = max(no_link_cost, 1.0) * 1e-9
+    rows = np.concatenate([source, np.arange(n_source), n_source + np.arange(n_target), n_source + target])
+    cols = np.concatenate([target, n_target + np.arange(n_source), np.arange(n_target), n_target + source])
+    weights = np.concatenate([cost + eps, np.full(n_source + n_target, no_link_cost + eps), np.full(n, eps)])
+    matrix = csr_matrix((weights, (rows, cols)), shape=(n_source + n_target, n_target + n_source))
+    row, col = min_weight_full_bipartite_matching(matrix)
+    assigned = (row < n_source) & (col < n_target)
+    return row[assigned], col[assigned]
+
+
+def close_gaps(df: pd.DataFrame, max_gap: int = 2, max_distance: float = 4, pos_columns: list = None) -> pd.DataFrame:
+    """
+    Join the ends of tracks to the starts of later tracks, for particles that blinked or were missed
+
+    The candidate (end, start) pairs within max_distance are found with a cKDTree
+    between the track ends and the track starts, kept when the start comes at most
+    max_gap frames after the end, and chosen by one sparse_assignment minimizing the
+    squared distances, so every end and every start is joined at most once.
+
+    params:
+        df: pd.DataFrame linked detections with frame, position and particle columns
+        max_gap: largest number of missing frames between an end and a start
+        max_distance: largest distance between an end and a start
+        pos_columns: position columns, default ['y', 'x'] (['z', 'y', 'x'] if there is a z column)
+
+    returns:
+        df: pd.DataFrame with the joined tracks renumbered in order of their first frame
+    """
+    if pos_columns is None:
+        pos_columns = ['z', 'y', 'x'] if 'z' in df.columns else ['y', 'x']
+    df = df.copy()
+    if len(df) == 0:
+        return df
+    frames = df['frame'].to_numpy().astype(np.int64)
+    positions = df[pos_columns].to_numpy(dtype=np.float64)
+    _, track = np.unique(df['particle'].to_numpy(), return_inverse=True)
+    n_tracks = track.max() + 1
+
+    # first and last row of every track
+    order = np.lexsort((frames, track))
+    bounds = np.flatnonzero(np.diff(track[order])) + 1
+    first = order[np.concatenate(([0], bounds))]
+    last = order[np.concatenate((bounds - 1, [len(order) - 1]))]
+
+    pairs = cKDTree(positions[last]).sparse_distance_matrix(cKDTree(positions[first]), max_distance,
+                                                             output_type='ndarray')
+    end, start, distance = pairs['i'].astype(np.int64), pairs['j'].astype(np.int64), pairs['v']
+    gap = frames[first][start] - frames[last][end]
+    keep = (gap > 0) & (gap <= max_gap + 1)
+    end, start = sparse_assignment(end[keep], start[keep], distance[keep] ** 2, n_tracks, n_tracks,
+                                   max_distance ** 2)
+
+    graph = coo_matrix((np.ones(len(end)), (end, start)), shape=(n_tracks, n_tracks))
+    _, joined = connected_components(graph, directed=False)
+    # renumber the joined tracks in order of their first point, as trackpy does
+    head = np.full(joined.max() + 1, len(df), dtype=np.int64)
+    np.minimum.at(head, joined, np.argsort(np.argsort(np.lexsort((first, frames[first])))))
+    df['particle'] = np.argsort(np.argsort(head))[joined[track]]
+    return df
+
+
+class KDTreeLinker:
+    """
+    Frame to frame linker on a KD-tree with a sparse linear assignment
+
+    Candidate links within search_range are found with cKDTree.sparse_distance_matrix
+    and all the links of a frame are chosen by one sparse_assignment minimizing the
+    squared displacements. Where a subnetwork of candidates (connected sources and
+    targets) has more than max_subnet_size members, the search range of its links is
+    shrunk by adaptive_step until it fits, or reaches adaptive_stop.
+
+    params:
+        search_range: maximum displacement between two frames
+        memory: number of frames a particle can vanish and still be linked
+        max_subnet_size: largest subnetwork before the search range is shrunk
+        adaptive_step: factor applied to the search range of an oversized subnetwork
+        adaptive_stop: smallest search range, default search_range / 4
+    """
+
+    def __init__(self, search_range: float, memory: int = 0, max_subnet_size: int = 30,
+                 adaptive_step: float = 0.95, adaptive_stop: float = None):
+        self.search_range = search_range
+        self.memory = memory
+        self.max_subnet_size = max_subnet_size
+        self.adaptive_step = adaptive_step
+        self.adaptive_stop = search_range / 4 if adaptive_stop is None else adaptive_stop
+        self.positions = None
+        self.frames = np.zeros(0, dtype=np.int64)
+        self.track_ids = np.zeros(0, dtype=np.int64)
+        self.n_tracks = 0
+
+    def _candidates(self, sources: np.ndarray, targets: np.ndarray) -> tuple:
+        if len(sources) == 0 or len(targets) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        pairs = cKDTree(sources).sparse_distance_matrix(cKDTree(targets), self.search_range, output_type='ndarray')
+        i, j, distance = pairs['i'].astype(np.int64), pairs['j'].astype(np.int64), pairs['v']
+
+        radius = np.full(len(i), float(self.search_range))
+        n = len(sources) + len(targets)
+        while len(i):
+            graph = coo_matrix((np.ones(len(i)), (i, len(sources) + j)), shape=(n, n))
+            _, component = connected_components(graph, directed=False)
+            oversize = np.bincount(component)[component[i]] > self.max_subnet_size
+            oversize &= radius > self.adaptive_stop
+            if not oversize.any():
+                break
+            radius[oversize] *= self.adaptive_step
+            keep = distance <= radius
+            i, j, distance, radius = i[keep], j[keep], distance[keep], radius[keep]
+        return i, j, distance
+
+    def predict(self, frame: int) -> np.ndarray:
+        return self.positions
+
+    def link_frame(self, frame: int, positions: np.ndarray) -> np.ndarray:
+        """
+        Link the detections of the next frame
+
+        returns:
+            track_ids: np.ndarray track id of every detection
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        if self.positions is None:
+            self.positions = np.zeros((0, positions.shape[1]))
+
+        # tracks that vanished for longer than memory are closed
+        alive = (frame - self.frames) <= self.memory + 1
+        self._keep_tracks(alive)
+
+        i, j, distance = self._candidates(self.predict(frame), positions)
+        source, target = sparse_assignment(i, j, distance ** 2, len(self.positions), len(positions),
+                                           self.search_range ** 2)
+
+        track_ids = np.full(len(positions), -1, dtype=np.int64)
+        track_ids[target] = self.track_ids[source]
+        new = np.flatnonzero(track_ids < 0)
+        track_ids[new] = self.n_tracks + np.arange(len(new))
+        self.n_tracks += len(new)
+
+        self._update_tracks(frame, positions, source, target, new, track_ids)
+        return track_ids
+
+    def _keep_tracks(self, keep: np.ndarray):
+        self.positions = self.positions[keep]
+        self.frames = self.frames[keep]
+        self.track_ids = self.track_ids[keep]
+
+    def _update_tracks(self, frame, positions, source, target, new, track_ids):
+        self.positions[source] = positions[target]
+        self.frames[source] = frame
+        self.positions = np.concatenate([self.positions, positions[new]])
+        self.frames = np.concatenate([self.frames, np.full(len(new), frame, dtype=np.int64)])
+        self.track_ids = np.concatenate([self.track_ids, track_ids[new]])
+
+
+class VelocityKDTreeLinker(KDTreeLinker):
+    """
+    KDTreeLinker searching around the position predicted from the last velocity of every track
+
+    Directed motion is followed with a search_range set by the error of the
+    prediction instead of the displacement between two frames.
+    """
+
+    def __init__(self, search_range: float, memory: int = 0, **kwargs):
+        super().__init__(search_range, memory=memory, **kwargs)
+        self.velocities = None
+
+    def predict(self, frame: int) -> np.ndarray:
+        if self.velocities is None:
+            self.velocities = np.zeros_like(self.positions)
+        return self.positions + self.velocities * (frame - self.frames)[:, None]
+
+    def _keep_tracks(self, keep: np.ndarray):
+        super()._keep_tracks(keep)
+        if self.velocities is not None:
+            self.velocities = self.velocities[keep]
+
+    def _update_tracks(self, frame, positions, source, target, new, track_ids):
+        self.velocities[source] = (positions[target] - self.positions[source]) / \
+            (frame - self.frames[source])[:, None]
+        self.velocities = np.concatenate([self.velocities, np.zeros((len(new), positions.shape[1]))])
+        super()._update_tracks(frame, positions, source, target, new, track_ids)
+
+
+class TrackVelocityPredict:
+    """
+    trackpy predictor extrapolating the last velocity of every track, pass it as predictor to trackpy.link
+
+    trackpy may ask for the same points several times, the last two points of
+    every track are kept by track id so the predictions do not depend on it.
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.previous = {}
+
+    def __call__(self, t1: int, particles) -> np.ndarray:
+        predicted = []
+        for p in particles:
+            track = p.track.id
+            last = self.last.get(track)
+            if last is None or last[0] < p.t:
+                if last is not None:
+                    self.previous[track] = last
+                last = self.last[track] = (p.t, p.pos)
+            previous = self.previous.get(track)
+            if previous is None:
+                predicted.append(p.pos)
+            else:
+                velocity = (last[1] - previous[1]) / (last[0] - previous[0])
+                predicted.append(p.pos + velocity * (t1 - p.t))
+        return np.asarray(predicted)
+
+
+def link_kdtree(df: pd.DataFrame, search_range: float = 2, memory: int = 0, pos_columns: list = None,
+                predict: bool = False, **kwargs) -> pd.DataFrame:
+    """
+    Link the detections with KDTreeLinker, frame by frame
+
+    params:
+        df: pd.DataFrame detections with frame and position columns
+        pos_columns: position columns, default ['y', 'x'] (['z', 'y', 'x'] if there is a z column)
+        predict: search around the positions extrapolated from the track velocities (VelocityKDTreeLinker)
+        kwargs: KDTreeLinker parameters
+
+    returns:
+        df: pd.DataFrame sorted by frame with a particle column as trackpy.link
+    """
+    if pos_columns is None:
+        pos_columns = ['z', 'y', 'x'] if 'z' in df.columns else ['y', 'x']
+    df = df.sort_values('frame', kind='stable')
+    frames = df['frame'].to_numpy().astype(np.int64)
+    positions = df[pos_columns].to_numpy(dtype=np.float64)
+    bounds = np.flatnonzero(np.diff(frames)) + 1
+
+    linker = (VelocityKDTreeLinker if predict else KDTreeLinker)(search_range, memory=memory, **kwargs)
+    particle = [linker.link_frame(f[0], p) for f, p in zip(np.split(frames, bounds), np.split(positions, bounds))
+                if len(f)]
+    df = df.copy()
+    df['particle'] = np.concatenate(particle) if particle else np.zeros(0, dtype=np.int64)
+    return df
+
+
+def _has_trackpy_linker() -> bool:
+    return Linker is not None \
+        and all(hasattr(Linker, a) for a in ('init_level', 'next_level', 'particle_ids')) \
+        and hasattr(Point, 'counter') and hasattr(TrackUnstored, 'counter')
+
+
+class IncrementalLinker:
+    """
+    Linker keeping its state between calls, for detections appended while a movie is acquired
+
+    Every append extends the open tracks with the new frames and starts new ones,
+    the already linked frames are never relinked. The track ids are the same as
+    get_tracks with the same backend on all the detections at once.
+
+    params:
+        search_range: maximum displacement between two frames
+        memory: number of frames a particle can vanish and still be linked
+        backend: 'trackpy' or 'kdtree', as get_tracks, 'trackpy' drives the internal trackpy
+            Linker and raises ImportError if the installed trackpy does not have it
+        pos_columns: position columns, default ['y', 'x'] (['z', 'y', 'x'] if there is a z column)
+        kwargs: parameters of the backend linker (trackpy Linker or KDTreeLinker)
+    """
+
+    def __init__(self, search_range: float = 2, memory: int = 0, backend: str = 'trackpy',
+                 pos_columns: list = None, **kwargs):
+        if backend not in ('trackpy', 'kdtree'):
+            raise ValueError(f"Unknown backend {backend}")
+        if backend == 'trackpy' and not _has_trackpy_linker():
+            raise ImportError(f"IncrementalLinker needs the Linker internals of trackpy, which trackpy "
+                              f"{trackpy.__version__} does not provide, use backend='kdtree'")
+        self.search_range = search_range
+        self.memory = memory
+        self.backend = backend
+        self.pos_columns = pos_columns
+        self.kwargs = kwargs
+        self.last_frame = None
+        self._linker = None
+        # trackpy numbers points and tracks with class level counters, each linker keeps its own
+        self._counters = None
+        self._linked = []
+
+    def _link_level(self, frame: int, positions: np.ndarray) -> np.ndarray:
+        if self.backend == 'kdtree':
+            if self._linker is None:
+                self._linker = KDTreeLinker(self.search_range, memory=self.memory, **self.kwargs)
+            return self._linker.link_frame(frame, positions)
+
+        counters = Point.counter, TrackUnstored.counter
+        try:
+            if self._linker is None:
+                self._linker = Linker(self.search_range, memory=self.memory, **self.kwargs)
+                self._linker.init_level(positions, frame)
+            else:
+                Point.counter, TrackUnstored.counter = self._counters
+                self._linker.next_level(positions, frame)
+            self._counters = Point.counter, TrackUnstored.counter
+        finally:
+            Point.counter, TrackUnstored.counter = counters
+        return np.asarray(self._linker.particle_ids, dtype=np.int64)
+
+    def append(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Link the detections of the next frames
+
+        params:
+            df: pd.DataFrame detections of one or more frames, all after the last appended frame
+
+        returns:
+            df: pd.DataFrame sorted by frame with the particle column
+        """
+        if self.pos_columns is None:
+            self.pos_columns = ['z', 'y', 'x'] if 'z' in df.columns else ['y', 'x']
+        df = df.sort_values('frame', kind='stable').copy()
+        df['frame'] = df['frame'].astype(np.int64)
+        if len(df) == 0:
+            df['particle'] = np.zeros(0, dtype=np.int64)
+            return df
+        frames = df['frame'].to_numpy()
+        if self.last_frame is not None and frames[0] <= self.last_frame:
+            raise ValueError(f"Frame {frames[0]} was already linked, last frame is {self.last_frame}")
+        positions = df[self.pos_columns].to_numpy(dtype=np.float64)
+        bounds = np.flatnonzero(np.diff(frames)) + 1
+
+        # frames without detections between the appended ones are linked as empty levels, as trackpy does
+        start = frames[0] if self.last_frame is None else self.last_frame + 1
+        particle = []
+        for f, p in zip(np.split(frames, bounds), np.split(positions, bounds)):
+            for empty in range(start, f[0]):
+                self._link_level(empty, np.zeros((0, len(self.pos_columns))))
+            particle.append(self._link_level(f[0], p))
+            start = f[0] + 1
+        self.last_frame = frames[-1]
+
+        df['particle'] = np.concatenate(particle)
+        self._linked.append(df)
+        return df
+
+    def to_pd(self) -> pd.DataFrame:
+        """
+        All the linked detections
+
+        returns:
+            df: pd.DataFrame sorted by frame with the particle column
+        """
+        if len(self._linked) == 0:
+            return pd.DataFrame()
+        return pd.concat(self._linked)
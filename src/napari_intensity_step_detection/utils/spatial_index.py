@@ -0,0 +1,113 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from skimage.measure import points_in_poly
+
+
+def shape_polygons(shape_layer) -> list:
+    """
+    Polygons of the rectangles, polygons and ellipses of a napari Shapes layer
+
+    params:
+        shape_layer: napari.layers.Shapes or None
+
+    returns:
+        polygons: list of np.ndarray (n_vertices, 2) in (y, x)
+    """
+    if shape_layer is None:
+        return []
+    data = shape_layer.data if isinstance(shape_layer.data, list) else [shape_layer.data]
+    shape_types = getattr(shape_layer, 'shape_type', None) or ['rectangle'] * len(data)
+    polygons = []
+    for vertices, shape_type in zip(data, shape_types):
+        vertices = np.asarray(vertices, dtype=np.float64)[:, -2:]
+        if shape_type == 'ellipse':
+            # napari keeps the 4 corners of the bounding box of the ellipse
+            center = vertices.mean(axis=0)
+            angle = np.linspace(0, 2 * np.pi, 64, endpoint=False)[:, None]
+            vertices = center + np.cos(angle) * (vertices[1] - vertices[0]) / 2 \
+                + np.sin(angle) * (vertices[3] - vertices[0]) / 2
+        elif shape_type not in ('rectangle', 'polygon'):
+            continue
+        polygons.append(vertices)
+    return polygons
+
+
+class TrackSpatialIndex:
+    """
+    Spatial index over tracks for region queries
+
+    The start points of the tracks are kept in a cKDTree, a query only tests the
+    tracks within the bounding box of every shape. Axis aligned rectangles are
+    tested inclusively (as Track.is_in_bbox) and the other shapes with points_in_poly.
+
+    params:
+        starts: np.ndarray (n_tracks, 2) first (y, x) of every track
+        lower, upper: np.ndarray (n_tracks, 2) bounding boxes of the tracks, default the start points
+    """
+
+    def __init__(self, starts: np.ndarray, lower: np.ndarray = None, upper: np.ndarray = None):
+        self.starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+        self.lower = self.starts if lower is None else np.asarray(lower, dtype=np.float64)
+        self.upper = self.starts if upper is None else np.asarray(upper, dtype=np.float64)
+        self.tree = cKDTree(self.starts)
+
+    @classmethod
+    def from_points(cls, points: np.ndarray, offsets: np.ndarray):
+        """
+        Index of tracks stored as TrackTable does, the last two columns of points are (y, x)
+
+        params:
+            points: np.ndarray (n_points, d) positions sorted by track
+            offsets: np.ndarray first row of every track, followed by the number of rows
+        """
+        points = np.asarray(points, dtype=np.float64)[:, -2:]
+        first = np.asarray(offsets[:-1], dtype=np.int64)
+        if len(first) == 0:
+            return cls(np.zeros((0, 2)))
+        return cls(points[first], np.minimum.reduceat(points, first), np.maximum.reduceat(points, first))
+
+    def query(self, polygons: list, on: str = 'start') -> np.ndarray:
+        """
+        Tracks within any of the polygons
+
+        params:
+            polygons: list of np.ndarray (n_vertices, 2) in (y, x), as shape_polygons
+            on: 'start' the start point of the track is inside the polygon,
+                'bbox' the bounding box of the track overlaps the bounding box of the polygon
+
+        returns:
+            inside: np.ndarray of bool, one per track
+        """
+        if on not in ('start', 'bbox'):
+            raise ValueError(f"Unknown query {on}")
+        inside = np.zeros(len(self.starts), dtype=bool)
+        for polygon in polygons:
+            polygon = np.asarray(polygon, dtype=np.float64)[:, -2:]
+            low, high = polygon.min(axis=0), polygon.max(axis=0)
+            if on == 'bbox':
+                inside |= np.all((self.lower <= high) & (self.upper >= low), axis=1)
+                continue
+            candidates = np.asarray(self.tree.query_ball_point((low + high) / 2, np.max(high - low) / 2, p=np.inf),
+                                    dtype=np.int64)
+            if len(candidates) == 0:
+                continue
+            points = self.starts[candidates]
+            in_box = np.all((points >= low) & (points <= high), axis=1)
+            if not _is_axis_aligned_rectangle(polygon):
+                in_box[in_box] = points_in_poly(points[in_box], polygon)
+            inside[candidates[in_box]] = True
+        return inside
+
+    def query_rectangle(self, top_left, bottom_right, on: str = 'start') -> np.ndarray:
+        """
+        Tracks within the rectangle of two opposite corners, in any order
+        """
+        (y0, x0), (y1, x1) = np.asarray(top_left)[-2:], np.asarray(bottom_right)[-2:]
+        return self.query([np.array([[y0, x0], [y0, x1], [y1, x1], [y1, x0]])], on=on)
+
+
+def _is_axis_aligned_rectangle(polygon: np.ndarray) -> bool:
+    if len(polygon) != 4:
+        return False
+    low, high = polygon.min(axis=0), polygon.max(axis=0)
+    return bool(np.all((polygon == low) | (polygon == high)))
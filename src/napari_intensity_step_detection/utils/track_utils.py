@@ -1,3 +1,7 @@
+import os
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import trackpy
@@ -5,8 +9,11 @@ from skimage import measure
 from tqdm import tqdm
 import napari
 import warnings
+from scipy import ndimage
 from scipy.optimize import curve_fit
 from math import sqrt
+from .linking import link_partitioned, link_kdtree, close_gaps, TrackVelocityPredict
+from .label_statistics import label_statistics, tiled_label_statistics, background_statistics
 
 
 class TrackLabels:
@@ -21,29 +28,169 @@ class TrackLabels:
                           'intensity_max', 'intensity_min', 'area', 'frame', 'track_id']
 
 
-def get_frame_position_properties(frame: int, mask: np.ndarray, image: np.ndarray = None, result: pd.DataFrame = None,
-                                  generate_label: bool = True) -> pd.DataFrame:
+PROPERTIES_KEYS = ['label', 'centroid', 'intensity_mean', 'intensity_max', 'intensity_min', 'area']
+
+
+class FramePropertiesBuilder:
+    """
+    Columnar accumulator for per frame region properties.
+
+    Every frame adds one array per column and the DataFrame is only
+    materialized once in to_pd, instead of growing it with pd.concat per frame.
+
+    params:
+        float_dtype: dtype of the position, subpixel, intensity and area columns
+    """
+
+    def __init__(self, float_dtype=np.float64):
+        self.float_dtype = np.dtype(float_dtype)
+        self.columns = {}
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return sum(len(c) for c in next(iter(self.columns.values())))
+
+    def add_frame(self, columns: dict):
+        for name, values in columns.items():
+            if values.dtype.kind == 'f':
+                values = values.astype(self.float_dtype, copy=False)
+            self.columns.setdefault(name, []).append(values)
+
+    def extend(self, other: "FramePropertiesBuilder"):
+        for name, chunks in other.columns.items():
+            self.columns.setdefault(name, []).extend(chunks)
+
+    def to_pd(self) -> pd.DataFrame:
+        return pd.DataFrame({name: np.concatenate(chunks) for name, chunks in self.columns.items()})
+
+
+def _properties_to_columns(frame: int, properties: dict) -> dict:
+    # regionprops_table like dict to the frame table columns
+    pos_columns = ['z', 'y', 'x'] if 'centroid-2' in properties else ['y', 'x']
+    columns = {}
+    for key, values in properties.items():
+        if key.startswith('centroid-'):
+            key = pos_columns[int(key.split('-')[1])]
+        elif '-' in key:
+            # multi channel intensity, intensity_mean-1 -> intensity_mean_c1
+            key = '{}_c{}'.format(*key.split('-'))
+        columns[key] = values
+    n = len(columns['label'])
+    columns['frame'] = np.full(n, frame, dtype=np.int64)
+    for p in pos_columns:
+        columns['sub_{}'.format(p)] = np.mod(columns[p], 1)
+    return columns
+
+
+def get_frame_properties_columns(frame: int, mask: np.ndarray, image: np.ndarray = None,
+                                 generate_label: bool = True, backend: str = 'skimage', tile_shape: tuple = None,
+                                 tile_workers: int = 1, background: str = None, annulus: tuple = (2, 6)) -> dict:
+    """
+    Measure the regions of one frame
+
+    params:
+        image: (Y, X) intensity image, or (Y, X, C) to measure every channel
+            with the same labels into intensity_mean_c0, intensity_mean_c1, ... columns
+        backend: 'skimage' measures with measure.regionprops_table,
+            'ndimage' with the vectorized label_statistics
+        tile_shape: label and measure the frame in tiles of this shape with
+            tiled_label_statistics, same rows as untiled but bounded memory, any backend
+        tile_workers: number of tiles measured concurrently
+        background: None, 'median' or 'mean', adds the local background of an annulus
+            around every region and the background corrected intensity and snr columns
+        annulus: (inner, outer) distance in pixels of the background annulus
+
+    returns:
+        columns: dict of column name to np.ndarray, one entry per region
+    """
+    if tile_shape is not None:
+        if background is not None:
+            raise ValueError("Background correction is not supported with tiled labelling")
+        properties = tiled_label_statistics(mask, image, tile_shape=tile_shape,
+                                            generate_label=generate_label, n_workers=tile_workers)
+        return _properties_to_columns(frame, properties)
+
     mask_label = measure.label(mask) if generate_label else mask
-    properties_keys = ['label', 'centroid', 'intensity_mean',
-                       'intensity_max', 'intensity_min', 'area']
-    properties = measure.regionprops_table(
-        label_image=mask_label, intensity_image=image, properties=properties_keys)
-    pf = pd.DataFrame(properties)
-    pf['frame'] = frame
-    pos_columns = ['y', 'x']
-
-    if 'centroid-2' in pf.columns:
-        pf.rename(columns={'centroid-0': 'z',
-                  'centroid-1': 'y',
-                           'centroid-0': 'x'}, inplace=True)
-        pos_columns = ['z', 'y', 'x']
+    if backend == 'skimage':
+        properties = measure.regionprops_table(
+            label_image=mask_label, intensity_image=image, properties=PROPERTIES_KEYS)
+    elif backend == 'ndimage':
+        properties = label_statistics(mask_label, image)
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+    if background is not None:
+        properties.update(_background_properties(mask_label, image, properties, background, annulus))
+    return _properties_to_columns(frame, properties)
+
+
+def _background_properties(labels, image, properties, background, annulus, batch=False):
+    if image is None:
+        raise ValueError("Background correction needs an intensity image")
+    if 'intensity_mean' in properties:
+        intensity_mean = [properties['intensity_mean']]
+    else:
+        intensity_mean = [properties[f'intensity_mean-{c}'] for c in range(np.shape(image)[-1])]
+    return background_statistics(labels, image, properties['label'], intensity_mean,
+                                 annulus=annulus, statistic=background, batch=batch)
+
+
+def _stack_label(masks: np.ndarray) -> np.ndarray:
+    # label all the frames in one call, objects only connect within their own frame
+    masks = np.asarray(masks)
+    structure = np.zeros((3,) * masks.ndim, dtype=bool)
+    structure[1] = True
+    labels, _ = ndimage.label(masks, structure=structure)
+    return labels.astype(np.int64)
+
+
+def _get_frames_properties_columns(frames: list, masks: np.ndarray, images: np.ndarray,
+                                   generate_label: bool = True, background: str = None,
+                                   annulus: tuple = (2, 6), stack_label: bool = False) -> list:
+    # 'ndimage' backend for a batch of frames, the labels are made unique over the
+    # batch so every frame is measured by the same label_statistics call
+    if generate_label and stack_label:
+        # labels already unique and in raster order, frame t holds the labels after the previous frames
+        labels = _stack_label(masks)
+        maxima = np.maximum.accumulate(labels.reshape(len(labels), -1).max(axis=1, initial=0))
+        offsets = np.concatenate(([0], maxima[:-1]))
+        counts = maxima - offsets
     else:
-        pf.rename(columns={'centroid-0': 'y',
-                  'centroid-1': 'x'}, inplace=True)
-    pos_subpixel_columns = ['sub_{}'.format(p) for p in pos_columns]
-    pf[pos_subpixel_columns] = pf[pos_columns].applymap(lambda x: x % 1)
-    # _sub_pixel_bias = np.vectorize(lambda x: x % 1)
-    # t.subpixel_bias = _sub_pixel_bias(t.points)
+        labels = np.stack([measure.label(m) if generate_label else np.asarray(m) for m in masks]).astype(np.int64)
+        counts = labels.reshape(len(labels), -1).max(axis=1, initial=0)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        labels = np.where(labels > 0, labels + offsets.reshape((-1,) + (1,) * (labels.ndim - 1)), 0)
+
+    properties = label_statistics(labels, images)
+    if background is not None:
+        properties.update(_background_properties(labels, images, properties, background, annulus, batch=True))
+    bounds = np.searchsorted(properties['label'], offsets + counts, side='right')
+    result = []
+    start = 0
+    for frame, offset, stop in zip(frames, offsets, bounds):
+        # centroid-0 is the position in the batch, the frame centroids shift by one axis
+        frame_properties = {}
+        for key, values in properties.items():
+            if key == 'centroid-0':
+                continue
+            if key.startswith('centroid-'):
+                key = 'centroid-{}'.format(int(key.split('-')[1]) - 1)
+            frame_properties[key] = values[start:stop]
+        frame_properties['label'] = frame_properties['label'] - offset
+        result.append(_properties_to_columns(frame, frame_properties))
+        start = stop
+    return result
+
+
+def get_frame_position_properties(frame: int, mask: np.ndarray, image: np.ndarray = None, result: pd.DataFrame = None,
+                                  generate_label: bool = True, float_dtype=np.float64,
+                                  backend: str = 'skimage', tile_shape: tuple = None, background: str = None,
+                                  annulus: tuple = (2, 6), tile_workers: int = 1) -> pd.DataFrame:
+    builder = FramePropertiesBuilder(float_dtype=float_dtype)
+    builder.add_frame(get_frame_properties_columns(
+        frame=frame, mask=mask, image=image, generate_label=generate_label, backend=backend,
+        tile_shape=tile_shape, tile_workers=tile_workers, background=background, annulus=annulus))
+    pf = builder.to_pd()
 
     if result is None:
         result = pf
@@ -53,25 +200,434 @@ def get_frame_position_properties(frame: int, mask: np.ndarray, image: np.ndarra
     return result
 
 
+class FramePropertiesCache:
+    """
+    Per frame cache of measured region properties.
+
+    Frames are keyed by a content hash of the mask frame, the image frame and
+    the measurement options, so measuring the stack again only measures the
+    frames whose mask or image changed. With max_bytes the least recently used
+    frames are dropped once the cached columns take more memory.
+
+    params:
+        max_bytes: size limit of the cached columns, None for no limit
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self._frames = OrderedDict()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    @staticmethod
+    def key(mask: np.ndarray, image: np.ndarray, options: dict = None) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for a in (mask, image):
+            a = np.ascontiguousarray(a)
+            h.update(f"{a.shape}{a.dtype.str}".encode())
+            h.update(a.view(np.uint8).ravel())
+        h.update(repr((PROPERTIES_KEYS, sorted((options or {}).items()))).encode())
+        return h.hexdigest()
+
+    def get(self, key: str, frame: int) -> dict:
+        columns = self._frames.get(key)
+        if columns is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._frames.move_to_end(key)
+        columns = dict(columns)
+        columns['frame'] = np.full(len(columns['frame']), frame, dtype=np.int64)
+        return columns
+
+    def set(self, key: str, columns: dict):
+        if key in self._frames:
+            self.nbytes -= self._size(self._frames.pop(key))
+        self._frames[key] = columns
+        self.nbytes += self._size(columns)
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and self._frames:
+            _, dropped = self._frames.popitem(last=False)
+            self.nbytes -= self._size(dropped)
+
+    @staticmethod
+    def _size(columns: dict) -> int:
+        return sum(np.asarray(v).nbytes for v in columns.values())
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+def _measure_frames(frames: list, masks: np.ndarray, images: np.ndarray, options: dict) -> list:
+    # worker for the parallel mode of get_statck_properties, kept at module level so it can be pickled
+    options = dict(options)
+    stack_label = options.pop('stack_label')
+    if (options['backend'] == 'ndimage' or stack_label) and options['tile_shape'] is None and len(frames):
+        return _get_frames_properties_columns(frames, masks, images, generate_label=options['generate_label'],
+                                              background=options['background'], annulus=options['annulus'],
+                                              stack_label=stack_label)
+    return [get_frame_properties_columns(frame=frame, mask=mask, image=image, **options)
+            for frame, mask, image in zip(frames, masks, images)]
+
+
+def _load_frames(stack, start: int, stop: int) -> np.ndarray:
+    # slicing keeps dask, zarr and memmap stacks lazy, only the requested frames are read
+    return np.asarray(stack[start:stop])
+
+
+class _ChannelStack:
+    # channels of the images sliced together, frames come out as (T, Y, X, C)
+    def __init__(self, images, channel_axis=None):
+        self.stacks = list(images) if channel_axis is None else [images]
+        shape = list(self.stacks[0].shape)
+        self.channel_axis = None if channel_axis is None else channel_axis % len(shape)
+        if channel_axis is not None:
+            self.n_channels = shape.pop(self.channel_axis)
+        else:
+            self.n_channels = len(self.stacks)
+            assert all(tuple(s.shape) == tuple(shape) for s in self.stacks)
+        self.shape = tuple(shape)
+
+    def __getitem__(self, key):
+        # only the time axis is indexed, by a frame or a slice of frames
+        if isinstance(key, tuple):
+            raise ValueError("Only the time axis of a channel stack can be indexed")
+        if self.channel_axis is None:
+            return np.stack([np.asarray(s[key]) for s in self.stacks], axis=-1)
+        # time is the first axis after the channel axis is taken out
+        index = (slice(None), key) if self.channel_axis == 0 else (key,)
+        axis = self.channel_axis
+        if isinstance(key, (int, np.integer)) and axis > 0:
+            # the time axis before the channel axis is gone
+            axis -= 1
+        return np.moveaxis(np.asarray(self.stacks[0][index]), axis, -1)
+
+
+def _as_channel_stack(images, channel_axis=None):
+    if isinstance(images, (list, tuple)) or channel_axis is not None:
+        return _ChannelStack(images, channel_axis=channel_axis)
+    return images
+
+
+class _StackChunk:
+    # frames of one chunk, the cached ones are filled in directly and the others are measured
+    def __init__(self, start, masks, images, options, cache=None):
+        self.frames = list(range(start, start + masks.shape[0]))
+        self.columns = [None] * len(self.frames)
+        self.keys = [None] * len(self.frames)
+        if cache is not None:
+            for i, frame in enumerate(self.frames):
+                self.keys[i] = cache.key(masks[i], images[i], options)
+                self.columns[i] = cache.get(self.keys[i], frame)
+        self.todo = [i for i, c in enumerate(self.columns) if c is None]
+        self.masks = masks[self.todo]
+        self.images = images[self.todo]
+
+    def measure_args(self, options):
+        return [self.frames[i] for i in self.todo], self.masks, self.images, options
+
+    def to_builder(self, measured, float_dtype, cache=None) -> FramePropertiesBuilder:
+        for i, columns in zip(self.todo, measured):
+            self.columns[i] = columns
+            if cache is not None:
+                cache.set(self.keys[i], columns)
+        builder = FramePropertiesBuilder(float_dtype=float_dtype)
+        for columns in self.columns:
+            builder.add_frame(columns)
+        return builder
+
+
+def _iter_stack_builders(masks, images, generate_label: bool = True, chunk_size: int = 16, n_workers: int = 1,
+                         use_processes: bool = True, float_dtype=np.float64, show_progress=False,
+                         cache: FramePropertiesCache = None, backend: str = 'skimage', tile_shape: tuple = None,
+                         background: str = None, annulus: tuple = (2, 6), stack_label: bool = False,
+                         tile_workers: int = 1):
+    if stack_label and tile_shape is not None:
+        raise ValueError("stack_label and tile_shape can not be used together")
+    n_frames = masks.shape[0]
+    options = {'generate_label': generate_label, 'backend': backend,
+               'tile_shape': None if tile_shape is None else tuple(tile_shape),
+               'background': background, 'annulus': tuple(annulus), 'stack_label': stack_label}
+    # the number of tile workers does not change the rows, it is left out of the cache keys
+    measure_options = {**options, 'tile_workers': tile_workers}
+    starts = range(0, n_frames, chunk_size)
+    if show_progress:
+        starts = tqdm(starts)
+
+    def _chunk(start):
+        stop = start + chunk_size
+        return _StackChunk(start, _load_frames(masks, start, stop), _load_frames(images, start, stop),
+                           options, cache=cache)
+
+    if n_workers <= 1:
+        for start in starts:
+            chunk = _chunk(start)
+            yield chunk.to_builder(_measure_frames(*chunk.measure_args(measure_options)), float_dtype, cache=cache)
+        return
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=n_workers) as executor:
+        pending = deque()
+        for start in starts:
+            chunk = _chunk(start)
+            future = executor.submit(_measure_frames, *chunk.measure_args(measure_options)) if chunk.todo else None
+            pending.append((chunk, future))
+            # only two chunks per worker are read ahead so the memory stays bounded,
+            # results are taken in submission order so the frames stay sorted
+            if len(pending) >= 2 * n_workers:
+                chunk, future = pending.popleft()
+                yield chunk.to_builder(future.result() if future else [], float_dtype, cache=cache)
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk.to_builder(future.result() if future else [], float_dtype, cache=cache)
+
+
+def iter_stack_properties(masks, images, generate_label: bool = True, chunk_size: int = 16, n_workers: int = 1,
+                          use_processes: bool = True, float_dtype=np.float64, show_progress=False,
+                          cache: FramePropertiesCache = None, backend: str = 'skimage', channel_axis: int = None,
+                          tile_shape: tuple = None, background: str = None, annulus: tuple = (2, 6),
+                          stack_label: bool = False, tile_workers: int = 1):
+    """
+    Lazily measure the region properties of the stack, chunk by chunk
+
+    masks and images can be any array-like with a shape and slicing
+    (np.ndarray, np.memmap, dask or zarr arrays), only chunk_size frames
+    per worker are read into memory at a time.
+
+    params:
+        see get_statck_properties
+
+    yields:
+        result: pd.DataFrame with the properties of chunk_size frames, in frame order
+    """
+    images = _as_channel_stack(images, channel_axis=channel_axis)
+    assert images.shape == masks.shape
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    for builder in _iter_stack_builders(masks, images, generate_label=generate_label, chunk_size=chunk_size,
+                                        n_workers=n_workers, use_processes=use_processes,
+                                        float_dtype=float_dtype, show_progress=show_progress, cache=cache,
+                                        backend=backend, tile_shape=tile_shape, background=background,
+                                        annulus=annulus, stack_label=stack_label, tile_workers=tile_workers):
+        yield builder.to_pd()
+
+
 def get_statck_properties(masks: np.ndarray, images: np.ndarray, result: pd.DataFrame = None,
-                          generate_label: bool = True, show_progress=False) -> pd.DataFrame:
+                          generate_label: bool = True, show_progress=False, n_workers: int = 1,
+                          chunk_size: int = 16, use_processes: bool = True, float_dtype=np.float64,
+                          cache: FramePropertiesCache = None, backend: str = 'skimage',
+                          channel_axis: int = None, tile_shape: tuple = None, background: str = None,
+                          annulus: tuple = (2, 6), stack_label: bool = False, tile_workers: int = 1) -> pd.DataFrame:
+    """
+    Measure the region properties of every frame of the stack
+
+    params:
+        masks: array-like (T, Y, X) binary masks or labels
+        images: array-like (T, Y, X) intensity images, or a list of them (one per channel)
+        n_workers: number of frames chunks measured concurrently,
+            1 measures on the calling thread, None uses all the cores
+        chunk_size: number of frames read and handed to a worker at once
+        use_processes: use a process pool (default) or a thread pool
+        float_dtype: dtype of the float columns, np.float32 halves the memory of large tables
+        cache: FramePropertiesCache, frames already measured with the same
+            mask and image are taken from the cache instead of measured again
+        backend: 'skimage' measures every frame with measure.regionprops_table,
+            'ndimage' measures a whole chunk of frames at once with the vectorized label_statistics
+        channel_axis: axis of the channels in images, every channel is measured
+            with the same labels into intensity_mean_c0, intensity_mean_c1, ... columns
+        tile_shape: label and measure every frame in tiles of this shape, for frames
+            too large to label at once, the rows are the same as untiled
+        tile_workers: number of tiles of a frame measured concurrently in threads,
+            within every frames worker
+        background: None, 'median' or 'mean' of an annulus around every region,
+            adds background, background_std, intensity_mean_bg and snr columns
+        annulus: (inner, outer) distance in pixels of the background annulus
+        stack_label: label every chunk of frames with a single ndimage.label call that
+            does not connect objects across frames, then measure it with one label_statistics
+            reduction, removes the per frame overhead of long movies of small frames
+
+    returns:
+        result: pd.DataFrame ordered by frame
+
+    also see:
+        iter_stack_properties
+    """
+    images = _as_channel_stack(images, channel_axis=channel_axis)
     assert images.shape == masks.shape
 
-    iter_range = tqdm(range(images.shape[0])) if show_progress else range(
-        images.shape[0])
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    builder = FramePropertiesBuilder(float_dtype=float_dtype)
+    for chunk in _iter_stack_builders(masks, images, generate_label=generate_label, chunk_size=chunk_size,
+                                      n_workers=n_workers, use_processes=use_processes,
+                                      float_dtype=float_dtype, show_progress=show_progress, cache=cache,
+                                      backend=backend, tile_shape=tile_shape, background=background,
+                                      annulus=annulus, stack_label=stack_label, tile_workers=tile_workers):
+        builder.extend(chunk)
+
+    pf = builder.to_pd()
+    if result is not None:
+        return pd.concat([result, pf], ignore_index=True)
+    return pf
+
+
+def get_tracks(df: pd.DataFrame, search_range: float = 2, memory: int = 0, show_progress: bool = False,
+               tile_shape: tuple = None, overlap: float = None, n_workers: int = None,
+               backend: str = 'trackpy', max_gap: int = 0, gap_distance: float = None,
+               predict: bool = False) -> pd.DataFrame:
+    """
+    Link the detections into tracks with trackpy
+
+    params:
+        df: pd.DataFrame detections, as returned by get_statck_properties
+        search_range: maximum displacement between two frames
+        memory: number of frames a particle can vanish and still be linked
+        tile_shape: link overlapping spatial tiles of this shape in parallel
+            processes and stitch them, see link_partitioned
+        overlap: width of the tiles overlap
+        n_workers: number of processes of the tiled linking, None uses all the cores
+        backend: 'trackpy' or 'kdtree' (KDTreeLinker with adaptive search range,
+            for dense fields), the tiled linking always uses trackpy
+        max_gap: if > 0, join the track ends to the track starts up to max_gap missing
+            frames later with close_gaps, cheaper than a large memory
+        gap_distance: largest distance of the gap closing, default search_range * (max_gap + 1)
+        predict: search around the position extrapolated from the last velocity of every track,
+            for directed motion search_range is then the error of the prediction
+            (the first step of a track, without velocity yet, must still be within search_range)
+
+    returns:
+        df: pd.DataFrame with the particle column
+    """
+    trackpy.quiet((not show_progress))
+    if backend not in ('trackpy', 'kdtree'):
+        raise ValueError(f"Unknown backend {backend}")
+    if predict and tile_shape is not None:
+        raise ValueError("predict can not be used with tile_shape")
+    if tile_shape is not None:
+        tracked = link_partitioned(df, search_range=search_range, memory=memory, tile_shape=tile_shape,
+                                   overlap=overlap, n_workers=n_workers)
+    elif backend == 'kdtree':
+        tracked = link_kdtree(df, search_range=search_range, memory=memory, predict=predict)
+    else:
+        tracked = trackpy.link(f=df, search_range=search_range, memory=memory,
+                               predictor=TrackVelocityPredict() if predict else None)
+    if max_gap > 0:
+        gap_distance = search_range * (max_gap + 1) if gap_distance is None else gap_distance
+        tracked = close_gaps(tracked, max_gap=max_gap, max_distance=gap_distance)
+    return tracked
+
 
-    for i in iter_range:
-        image = images[i]
-        mask = masks[i]
-        result = get_frame_position_properties(
-            frame=i, mask=mask, image=image, result=result, generate_label=generate_label)
+def tracks_msd(tracked: pd.DataFrame, limit: int = 26, track_column: str = 'track_id') -> tuple:
+    """
+    MSD over the frames of every track of a tracked DataFrame, with one batch_msd call
+
+    The lags are in frames, as msd of the positions reindexed over the frames of
+    the track: the lags without pairs are 0 and the lags past the track are nan.
 
+    params:
+        tracked: pd.DataFrame with track_column, frame, x and y columns
+        limit: number of lags
+        track_column: column of the track ids
+
+    returns:
+        tracked: pd.DataFrame the rows with a track id, sorted by track and frame
+        offsets: np.ndarray first row of every track, followed by the number of rows
+        msd: np.ndarray (n_tracks, limit)
+        n_lags: np.ndarray number of lags of every track, min(limit, frame span - 1)
+    """
+    tracked = tracked[tracked[track_column].notna()].sort_values([track_column, 'frame'], kind='stable')
+    track_ids = tracked[track_column].to_numpy()
+    frames = tracked['frame'].to_numpy().astype(np.int64)
+    first = np.flatnonzero(np.concatenate(([True], track_ids[1:] != track_ids[:-1]))) if len(track_ids) \
+        else np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate((first, [len(track_ids)]))
+    all_msd, _ = batch_msd(tracked[['x', 'y']].to_numpy(), offsets, limit=limit, frames=frames)
+    span = frames[offsets[1:] - 1] - frames[first] + 1
+    n_lags = np.minimum(limit, span - 1)
+    all_msd = np.where(np.arange(limit) < n_lags[:, None], np.nan_to_num(all_msd), np.nan)
+    return tracked, offsets, all_msd, n_lags
+
+
+def _tracks_msd_alpha(tracked: pd.DataFrame, delta: float = 1, limit: int = 25, min_length: int = 5) -> np.ndarray:
+    # msd fit alpha of every track at least min_length long, gaps are handled as in TrackAnalysis
+    _, offsets, all_msd, _ = tracks_msd(tracked, limit=limit, track_column='particle')
+    alpha, _, _ = batch_msd_fit(all_msd[np.diff(offsets) >= min_length], delta=delta, refine=50)
+    return alpha
+
+
+# detections of link_parameter_sweep, sent once to every worker process by _init_sweep
+_sweep_detections = None
+
+
+def _init_sweep(df: pd.DataFrame):
+    global _sweep_detections
+    _sweep_detections = df
+
+
+def _sweep_setting(search_range: float, memory: int, backend: str, bins: np.ndarray,
+                   delta: float, msd_limit: int, min_length: int) -> dict:
+    # worker of link_parameter_sweep, kept at module level so it can be pickled
+    result = {'search_range': search_range, 'memory': memory}
+    bin_columns = [f'[{lo:g}, {hi:g})' for lo, hi in zip(bins[:-1], bins[1:])]
+    # a setting that can not be linked (trackpy SubnetOversizeException for large search ranges)
+    # is reported as a nan row with its error instead of failing the whole sweep
+    try:
+        tracked = get_tracks(_sweep_detections, search_range=search_range, memory=memory, backend=backend)
+    except Exception as error:  # noqa: BLE001
+        result.update({'n_tracks': np.nan, 'mean_length': np.nan, 'msd_fit_alpha': np.nan})
+        result.update(dict.fromkeys(bin_columns, np.nan))
+        result['error'] = f"{type(error).__name__}: {error}"
+        return result
+    lengths = tracked.groupby('particle').size().to_numpy()
+    alpha = _tracks_msd_alpha(tracked, delta=delta, limit=msd_limit, min_length=min_length)
+    result.update({
+        'n_tracks': len(lengths),
+        'mean_length': lengths.mean() if len(lengths) else np.nan,
+        'msd_fit_alpha': np.nanmean(alpha) if np.any(~np.isnan(alpha)) else np.nan,
+    })
+    hist, _ = np.histogram(lengths, bins=bins)
+    result.update(dict(zip(bin_columns, hist)))
+    result['error'] = None
     return result
 
 
-def get_tracks(df: pd.DataFrame, search_range: float = 2, memory: int = 0, show_progress: bool = False) -> pd.DataFrame:
-    trackpy.quiet((not show_progress))
-    return trackpy.link(f=df, search_range=search_range, memory=memory)
+def link_parameter_sweep(df: pd.DataFrame, search_ranges, memories, backend: str = 'trackpy',
+                         n_workers: int = None, length_bins=10, delta: float = 1, msd_limit: int = 25,
+                         min_length: int = 5) -> pd.DataFrame:
+    """
+    Link the same detections for every (search_range, memory) pair in parallel processes
+
+    params:
+        df: pd.DataFrame detections, as returned by get_statck_properties, measured once
+        search_ranges: search_range values to try
+        memories: memory values to try
+        backend: linking backend of get_tracks
+        n_workers: number of processes, None uses all the cores
+        length_bins: number of track length bins, or the bin edges, same for every setting
+        delta: time between two frames for the msd fit
+        msd_limit: number of msd lag times fitted
+        min_length: shortest track used for the msd fit
+
+    returns:
+        sweep: pd.DataFrame one row per setting with n_tracks, mean_length,
+            the mean msd_fit_alpha and the number of tracks per length bin, the settings
+            that could not be linked have nan values and the exception in the error column
+    """
+    n_frames = int(df['frame'].max() - df['frame'].min()) + 1 if len(df) else 1
+    bins = np.histogram_bin_edges([1, n_frames + 1], bins=length_bins) if np.isscalar(length_bins) \
+        else np.asarray(length_bins)
+    settings = [(s, m) for s in search_ranges for m in memories]
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    # the detections are pickled once per worker process instead of once per setting
+    with ProcessPoolExecutor(max_workers=max(min(n_workers, len(settings)), 1), initializer=_init_sweep,
+                             initargs=(df,)) as executor:
+        futures = [executor.submit(_sweep_setting, s, m, backend, bins, delta, msd_limit, min_length)
+                   for s, m in settings]
+        return pd.DataFrame([f.result() for f in futures])
 
 
 def napari_track_to_pd(track_layer: napari.layers.Tracks, track_header: list, track_id):
@@ -87,18 +643,20 @@ def napari_track_to_pd(track_layer: napari.layers.Tracks, track_header: list, tr
     also see:
         pd_to_napari_tracks
     """
-    df = pd.DataFrame(track_layer.data, columns=track_header)
+    # the columns are views on the layer data and properties, the DataFrame is built once
+    data = np.asarray(track_layer.data)
+    columns = {th: data[:, i] for i, th in enumerate(track_header)}
     if not hasattr(track_layer, 'properties'):
         warnings.warn(
             "Track layer does not have properties produsing tracking without properties")
-        return df
+        return pd.DataFrame(columns)
 
     properties = track_layer.properties
     for property, values in properties.items():
         if property == track_id:
             continue
-        df[property] = values
-    return df
+        columns[property] = np.asarray(values)
+    return pd.DataFrame(columns, copy=False)
 
 
 def pd_to_napari_tracks(df: pd.DataFrame, track_header, track_meta_header):
@@ -133,9 +691,7 @@ def pd_to_napari_tracks(df: pd.DataFrame, track_header, track_meta_header):
                             tg['intensity_mean'].min()['intensity_mean']], axis=1)
     track_meta.columns = track_meta_header
 
-    properties = df[columns].to_dict()
-    properties = dict(
-        map(lambda kv: (kv[0], np.array(list(kv[1].values()))), properties.items()))
+    properties = {c: df[c].to_numpy() for c in columns}
 
     tracks = df[track_header].to_numpy()
 
@@ -174,7 +730,26 @@ def msd_old(track, limit=26, diff=vector_distance):
     return _mean
 
 
-def msd(pos, limit=25):
+def msd(pos, limit=25, method='direct'):
+    """
+    MSD of one track, the nan positions are skipped
+
+    params:
+        pos: np.ndarray (n_points, 2) positions
+        limit: number of lags, None for all of them
+        method: 'direct' O(n * limit) or 'fft' O(n log n), see batch_msd
+
+    returns:
+        msd: pd.Series indexed by the lags, 0 for the lags without pairs
+    """
+    if method == 'fft':
+        limit = len(pos) - 1 if limit is None else min(limit, len(pos) - 1)
+        y, _ = batch_msd(pos, [0, len(pos)], limit=limit, method='fft')
+        return pd.Series(np.nan_to_num(y[0]), index=np.arange(1, limit + 1), name='msd')
+    if method != 'direct':
+        raise ValueError(f"Unknown method {method}")
+    if limit is None:
+        limit = len(pos) - 1
     pos_columns = ['x', 'y']
     result_columns = ['<{}>'.format(p) for p in pos_columns] + \
         ['<{}^2>'.format(p) for p in pos_columns]
@@ -190,6 +765,112 @@ def msd(pos, limit=25):
     return result['msd']
 
 
+def _fill_gaps(points: np.ndarray, offsets: np.ndarray, frames: np.ndarray) -> tuple:
+    # positions of every track laid out over its whole frame range, missing frames are nan
+    first = frames[offsets[:-1]]
+    span = frames[offsets[1:] - 1] - first + 1
+    filled_offsets = np.concatenate(([0], np.cumsum(span)))
+    track = np.repeat(np.arange(len(span)), np.diff(offsets))
+    filled = np.full((filled_offsets[-1], points.shape[1]), np.nan)
+    filled[filled_offsets[:-1][track] + frames - first[track]] = points
+    return filled, filled_offsets
+
+
+def _correlate(a: np.ndarray, b: np.ndarray, n: int, limit: int) -> np.ndarray:
+    # lags 1..limit of the circular correlation of two rfft of length n
+    return np.fft.irfft(np.conj(a) * b, n=n, axis=-1)[..., 1:limit + 1]
+
+
+def _fft_msd(points: np.ndarray, offsets: np.ndarray, limit: int) -> tuple:
+    # MSD(m) = sum w_i w_i+m (x_i+m - x_i)^2 / sum w_i w_i+m expanded into correlations, all computed
+    # with FFTs; w masks the nan positions, tracks of similar length are transformed together
+    n_tracks = len(offsets) - 1
+    span = np.diff(offsets)
+    total = np.zeros((n_tracks, limit))
+    counts = np.zeros((n_tracks, limit))
+    size = 2 ** np.ceil(np.log2(2 * np.maximum(span, 1))).astype(np.int64)
+    for s in np.unique(size):
+        tracks = np.flatnonzero(size == s)
+        lengths = span[tracks]
+        rows = np.repeat(offsets[tracks] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) \
+            + np.arange(lengths.sum())
+        column = rows - np.repeat(offsets[tracks], lengths)
+        track = np.repeat(np.arange(len(tracks)), lengths)
+
+        valid = ~np.isnan(points[rows]).any(axis=1)
+        weight = np.zeros((len(tracks), s))
+        weight[track, column] = valid
+        # positions centered on every track keep the differences of the large sums accurate
+        pos = np.where(valid[:, None], points[rows], 0)
+        n_valid = np.maximum(np.bincount(track, weights=valid, minlength=len(tracks)), 1)
+        center = np.stack([np.bincount(track, weights=p, minlength=len(tracks)) for p in pos.T], axis=1)
+        x = np.zeros((points.shape[1], len(tracks), s))
+        x[:, track, column] = ((pos - center[track] / n_valid[track, None]) * valid[:, None]).T
+
+        w = np.fft.rfft(weight, axis=-1)
+        squared = np.fft.rfft(np.sum(x ** 2, axis=0), axis=-1)
+        fx = np.fft.rfft(x, axis=-1)
+        lags = min(limit, s - 1)
+        counts[tracks, :lags] = _correlate(w, w, s, limit)
+        total[tracks, :lags] = _correlate(w, squared, s, limit) + _correlate(squared, w, s, limit) \
+            - 2 * _correlate(fx, fx, s, limit).sum(axis=0)
+    # lags of span or more wrap around the padding
+    wrapped = np.arange(1, limit + 1) >= span[:, None]
+    total[wrapped] = 0
+    counts[wrapped] = 0
+    counts = np.rint(counts).astype(np.int64)
+    return np.maximum(total, 0), counts
+
+
+def batch_msd(points: np.ndarray, offsets: np.ndarray, limit: int = 25, frames: np.ndarray = None,
+              method: str = 'direct') -> tuple:
+    """
+    MSD curves of all the tracks at once
+
+    The tracks are stored one after the other, as in TrackTable. For every lag
+    the differences are taken over the whole array and the pairs that cross
+    from one track to the next are masked out, so there is no loop over the tracks.
+
+    params:
+        points: np.ndarray (n_points, d) positions sorted by track and frame
+        offsets: np.ndarray first row of every track, followed by the number of rows
+        limit: number of lags, None for all the lags of the longest track
+        frames: np.ndarray frame of every point, if given the lags are in frames and the
+            missing frames are skipped (as msd on positions reindexed with nan),
+            otherwise the lags are in rows (as Track.calculate_msd)
+        method: 'direct' one vectorized difference per lag, O(n_points * limit), or 'fft'
+            correlations of every track with FFTs, O(n_points log n_points) for all the lags,
+            for long tracks and full MSD curves
+
+    returns:
+        msd: np.ndarray (n_tracks, limit) mean squared displacement for the lags 1..limit,
+            nan where the track has no pair
+        counts: np.ndarray (n_tracks, limit) number of pairs of every lag
+    """
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if frames is not None:
+        points, offsets = _fill_gaps(points, offsets, np.asarray(frames, dtype=np.int64))
+    if limit is None:
+        limit = max(int(np.diff(offsets).max(initial=1)) - 1, 1)
+    if method == 'fft':
+        total, counts = _fft_msd(points, offsets, limit)
+        return np.divide(total, counts, out=np.full(total.shape, np.nan), where=counts > 0), counts
+    if method != 'direct':
+        raise ValueError(f"Unknown method {method}")
+    n_tracks = len(offsets) - 1
+    track = np.repeat(np.arange(n_tracks), np.diff(offsets))
+    total = np.zeros((n_tracks, limit))
+    counts = np.zeros((n_tracks, limit), dtype=np.int64)
+    for lag in range(1, min(limit, len(points) - 1) + 1):
+        squared = np.sum((points[lag:] - points[:-lag]) ** 2, axis=1)
+        valid = (track[lag:] == track[:-lag]) & ~np.isnan(squared)
+        total[:, lag - 1] = np.bincount(track[:-lag][valid], weights=squared[valid], minlength=n_tracks)
+        counts[:, lag - 1] = np.bincount(track[:-lag][valid], minlength=n_tracks)
+    msd = np.divide(total, counts, out=np.full(total.shape, np.nan), where=counts > 0)
+    return msd, counts
+
+
 """
 def calc_msd_simple(x):
     n = len(x)
@@ -215,6 +896,94 @@ def basic_msd_fit(msd_y, delta=3.8, limit=26, diff=vector_distance):
     return best_value[1], _y
 
 
+def batch_msd_fit(msd_y: np.ndarray, delta: float = 3.8, weights: np.ndarray = None, refine: int = 0) -> tuple:
+    """
+    Fit msd_fit_function to the MSD curves of all the tracks at once
+
+    (d, alpha) come in closed form from the weighted linear least squares of
+    log(msd) = log(4 d) + alpha log(lag) for every row. refine Newton iterations
+    on the least squares of the msd values themselves (as basic_msd_fit) can
+    follow, d being solved for every alpha so that only alpha is searched, all
+    the rows being updated together.
+
+    params:
+        msd_y: np.ndarray (n_tracks, n_lags) msd of the lags 1..n_lags, nan where missing
+        delta: time between two frames
+        weights: np.ndarray (n_tracks, n_lags) weights of the log-log fit, for example
+            the counts of batch_msd, default 1
+        refine: maximum number of Newton iterations, default 0 the closed form fit only,
+            the rows stop as soon as they have converged
+
+    returns:
+        alpha: np.ndarray (n_tracks,) nan where less than 2 lags can be fitted
+        d: np.ndarray (n_tracks,)
+        fitted: np.ndarray (n_tracks, n_lags) msd_fit_function of the fitted parameters
+    """
+    y = np.atleast_2d(np.asarray(msd_y, dtype=np.float64))
+    t = np.arange(1, y.shape[1] + 1) * delta
+    log_t = np.log(t)
+    w = np.ones_like(y) if weights is None else np.asarray(weights, dtype=np.float64).copy()
+    w[~(y > 0)] = 0
+    log_y = np.log(np.where(y > 0, y, 1))
+
+    sw, sx, sy = w.sum(axis=1), w @ log_t, (w * log_y).sum(axis=1)
+    sxx, sxy = w @ log_t ** 2, (w * log_y) @ log_t
+    det = sw * sxx - sx ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = np.where(det > 0, (sw * sxy - sx * sy) / det, np.nan)
+        c = np.exp((sy - alpha * sx) / sw)
+    if refine <= 0:
+        return alpha, c / 4, c[:, None] * t ** alpha[:, None]
+
+    # for y = c t^alpha the best c is a / b with a = sum(t^alpha y) and b = sum(t^2alpha),
+    # the fit maximizes log(a^2 / b), the part of the msd explained by t^alpha
+    valid = np.isfinite(y)
+    y0 = np.where(valid, y, 0)
+
+    def explained(rows, alpha):
+        f = np.where(valid[rows], np.exp(alpha[:, None] * log_t), 0)
+        return f, np.sum(f * y0[rows], axis=1), np.sum(f * f, axis=1)
+
+    active = np.flatnonzero(np.isfinite(alpha))
+    for _ in range(refine):
+        if len(active) == 0:
+            break
+        aa = alpha[active]
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            f, a, b = explained(active, aa)
+            f1 = f * log_t
+            f2 = f1 * log_t
+            a1, a2 = np.sum(f1 * y0[active], axis=1), np.sum(f2 * y0[active], axis=1)
+            b1, b2 = 2 * np.sum(f * f1, axis=1), 2 * np.sum(f1 * f1 + f * f2, axis=1)
+            gradient = 2 * a1 / a - b1 / b
+            hessian = 2 * (a2 * a - a1 ** 2) / a ** 2 - (b2 * b - b1 ** 2) / b ** 2
+            # away from a maximum a bounded step uphill
+            da = np.where(hessian < 0, -gradient / hessian, np.sign(gradient) * 0.1)
+            current = 2 * np.log(a) - np.log(b)
+        step = np.where(np.isfinite(da) & (a > 0), 1.0, 0.0)
+        better = np.zeros(len(active), dtype=bool)
+        todo = np.flatnonzero(step > 0)
+        for _ in range(20):
+            if len(todo) == 0:
+                break
+            with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+                _, a, b = explained(active[todo], aa[todo] + step[todo] * da[todo])
+                better[todo] = 2 * np.log(a) - np.log(b) >= current[todo]
+            todo = todo[~better[todo]]
+            step[todo] /= 2
+        alpha[active[better]] += step[better] * da[better]
+        # rows without improvement or with a negligible step have converged
+        moving = better & (np.abs(step * da) > 1e-10 * np.maximum(np.abs(aa), 1))
+        active = active[moving]
+
+    fit = np.flatnonzero(np.isfinite(alpha))
+    f, a, b = explained(fit, alpha[fit])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c[fit] = a / b
+    fitted = c[:, None] * t ** alpha[:, None]
+    return alpha, c / 4, fitted
+
+
 def velocity_fit(track, delta=3.8, limit=26, diff=vector_distance):
     y = np.array(msd(track, limit=limit, diff=diff))
     x = np.array(list(range(1, len(y) + 1))) * delta